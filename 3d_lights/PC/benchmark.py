@@ -0,0 +1,406 @@
+#!/usr/bin/python
+
+# benchmark.py
+
+r'''Benchmarks each stage of the 3d_lights content pipeline.
+
+    python benchmark.py [options] [stage...]
+
+The stages are (in pipeline order):
+
+    render      render.frame on synthetic scenes of growing complexity
+    geometry    render.frame of the bouncing ball on bigger platforms
+    to_binary   render.to_binary on the lights of a rendered frame
+    to_file     render.to_file, from a frame_buffer and from to_binary
+    escape      driver.escape_file on each of the shipped .bin files, then
+                from an escape_cache
+    serial      comm.write of the escaped .bin files through a pty
+    bulk        ways of writing the frames of the bigger .bin files through
+                a pty, with the system calls per MB
+    banner      sign.make_banner
+
+All of the stages are run if none are named.  Each result gives the frames
+and bytes per second for one case of one stage (the bytes are those the
+stage outputs).  The results are printed as a table and, with --json, also
+written as JSON.  Giving --compare a JSON file from an earlier run prints how
+each case's time has changed since then.
+'''
+
+from __future__ import division, with_statement
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import platform
+import tempfile
+import threading
+import optparse
+
+sys.path.insert(0,
+    os.path.abspath(
+        os.path.join(
+        os.path.dirname(__file__),
+        '../../tools/PC')))
+
+sys.path.insert(0,
+    os.path.abspath(
+        os.path.join(
+        os.path.dirname(__file__),
+        '../image')))
+
+from pyterm import comm
+
+import bouncing_ball
+import driver
+import geometry
+import render
+import shape
+import sign
+
+Version = 1         # of the JSON output
+
+Min_secs = 0.5      # time each case for at least this long
+
+Bin_dir = os.path.dirname(os.path.abspath(__file__))
+
+Geometries = (
+    geometry.geometry(50, 8, 16),
+    geometry.geometry(100, 8, 16),
+    geometry.geometry(100, 16, 16),
+    geometry.geometry(100, 16, 32),
+)
+
+Scene_sizes = (1, 2, 4, 8, 16, 32)
+
+def timeit(fn, min_secs = None):
+    r'''Calls fn until min_secs (Min_secs) have passed, returns (calls, secs).
+    '''
+    if min_secs is None: min_secs = Min_secs
+    calls = 0
+    start = time.time()
+    while True:
+        fn()
+        calls += 1
+        secs = time.time() - start
+        if secs >= min_secs: return calls, secs
+
+def result(stage, case, frames, num_bytes, secs, syscalls = None):
+    r'''One result, as it appears in the JSON output.
+
+        >>> r = result('escape', 'sign.bin', 10, 8010, 0.5)
+        >>> r['frames_per_sec'], r['bytes_per_sec']
+        (20.0, 16020.0)
+    '''
+    ans = {
+        'stage': stage,
+        'case': case,
+        'frames': frames,
+        'bytes': num_bytes,
+        'secs': secs,
+        'frames_per_sec': frames / secs,
+        'bytes_per_sec': num_bytes / secs,
+    }
+    if syscalls is not None:
+        ans['syscalls_per_mb'] = syscalls / (num_bytes / (1 << 20))
+    return ans
+
+class quiet(object):
+    r'''A context manager that throws away what's printed to sys.stdout.
+
+    driver.escape_file prints the file lengths.
+    '''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, exc_type = None, exc_value = None, exc_tb = None):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        return False
+
+def bin_files():
+    return sorted(name for name in os.listdir(Bin_dir)
+                       if name.endswith('.bin'))
+
+def scene(num_shapes, seed = 0):
+    r'''A repeatable scene of `num_shapes` assorted shapes in the platform.
+
+        >>> len(scene(8)), scene(8)[0].__class__.__name__
+        (8, 'sphere')
+    '''
+    rand = random.Random(seed)
+    def place():
+        angle = rand.uniform(0, 360)
+        return shape.point.semi_polar(angle, rand.uniform(0, 6),
+                                      rand.uniform(2, 13))
+    ans = []
+    for i in range(num_shapes):
+        kind = i % 4
+        p = place()
+        if kind == 0:
+            ans.append(shape.sphere(p, rand.uniform(1, 3)))
+        elif kind == 1:
+            size = shape.point(*(rand.uniform(1, 3) for _ in range(3)))
+            ans.append(shape.box(p, p + size))
+        elif kind == 2:
+            ans.append(shape.cylinder(p, rand.uniform(0.5, 2),
+                                      rand.uniform(2, 6)))
+        else:
+            ans.append(shape.torus(p, rand.uniform(1.5, 3), 0.5)
+                            .rotate(rand.uniform(0, 90), 'x'))
+    return tuple(ans)
+
+def bench_render():
+    into = render.frame_buffer()
+    for n in Scene_sizes:
+        shapes = scene(n)
+        calls, secs = timeit(lambda: render.frame(*shapes, into = into))
+        yield result('render', '%d shapes' % n, calls, calls * len(into),
+                     secs)
+
+def bench_geometry():
+    for geom in Geometries:
+        geom.load_lights()
+        geom.grid()
+        ball = bouncing_ball.ball(max(2, geom.radii // 4), geom)
+        scenes = iter(ball.scenes(sys.maxint))
+        into = render.frame_buffer(geom = geom)
+        calls, secs = timeit(lambda: render.frame(*next(scenes), into = into))
+        yield result('geometry', '%d x %d x %d' % geom.params()[:3],
+                     calls, calls * geom.frame_size, secs)
+
+def frame_bools(shapes):
+    frame = render.frame(*shapes)
+    return tuple(frame.test(i) for i in xrange(geometry.Default.num_lights))
+
+def bench_to_binary():
+    bools = frame_bools(scene(4))
+    calls, secs = timeit(lambda: bytearray(render.to_binary(bools)))
+    yield result('to_binary', '4 shapes', calls,
+                 calls * geometry.Default.frame_size, secs)
+
+def bench_to_file():
+    frame = render.frame(*scene(4))
+    bools = frame_bools(scene(4))
+    with tempfile.TemporaryFile() as f:
+        for case, fn in (
+          ('frame_buffer', lambda: render.to_file(f, frame)),
+          ('to_binary', lambda: render.to_file(f, render.to_binary(bools))),
+        ):
+            f.seek(0)
+            calls, secs = timeit(fn)
+            yield result('to_file', case, calls, calls * len(frame), secs)
+
+def bench_escape():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = driver.escape_cache(cache_dir)
+        for name in bin_files():
+            filename = os.path.join(Bin_dir, name)
+            with quiet():
+                frames = len(driver.file_frames(filename))
+                num_bytes = len(driver.escape_file(filename))
+                calls, secs = timeit(lambda: driver.escape_file(filename))
+            yield result('escape', name, calls * frames, calls * num_bytes,
+                         secs)
+            with quiet():
+                cache.escape_file(filename)
+                calls, secs = timeit(lambda: cache.escape_file(filename))
+            yield result('escape', name + ' cached', calls * frames,
+                         calls * num_bytes, secs)
+    finally:
+        shutil.rmtree(cache_dir)
+
+class pty_sink(object):
+    r'''A pty with a thread that reads (and throws away) whatever is written
+    to it.
+
+    Writes go to `fd`, which is set up by comm.stty just like the USB serial
+    port.  wait(num_bytes) waits until the reader has seen num_bytes.
+    '''
+    def __init__(self):
+        self.fd, self.slave = os.openpty()
+        comm.stty(self.slave)
+        self.num_bytes = 0
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            try:
+                data = os.read(self.slave, 1 << 16)
+            except OSError:
+                return
+            if not data: return
+            with self.cond:
+                self.num_bytes += len(data)
+                self.cond.notify()
+
+    def wait(self, num_bytes):
+        with self.cond:
+            while self.num_bytes < num_bytes:
+                self.cond.wait(1)
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.slave)
+
+def bench_serial():
+    sink = pty_sink()
+    try:
+        for name in bin_files():
+            filename = os.path.join(Bin_dir, name)
+            with quiet():
+                frames = len(driver.file_frames(filename))
+                data = driver.escape_file(filename)
+            def send():
+                done = sink.num_bytes + len(data)
+                comm.write(sink.fd, data)
+                sink.wait(done)
+            calls, secs = timeit(send)
+            yield result('serial', name, calls * frames, calls * len(data),
+                         secs)
+    finally:
+        sink.close()
+
+Bulk_files = ('banner.bin', 'cylinder-anim.bin')
+
+def copying_write(fd, s):
+    r'''comm.write as it used to be, copying the rest of s after each short
+    write.  Returns the number of system calls made.
+    '''
+    calls = 0
+    while s:
+        l = os.write(fd, s)
+        calls += 1
+        s = s[l:]
+    return calls
+
+def bench_bulk():
+    cache_dir = tempfile.mkdtemp()
+    sink = pty_sink()
+    try:
+        cache = driver.escape_cache(cache_dir)
+        for name in Bulk_files:
+            with quiet():
+                frames = cache.escaped_file_frames(os.path.join(Bin_dir, name))
+            data = ''.join(frames)
+            for case, send in (
+              ('copying write', lambda: copying_write(sink.fd, data)),
+              ('comm.write', lambda: comm.write(sink.fd, data)),
+              ('write per frame',
+                 lambda: sum(comm.write(sink.fd, frame) for frame in frames)),
+              ('write_frames', lambda: comm.write_frames(sink.fd, frames)),
+            ):
+                syscalls = [0]
+                def run_once():
+                    done = sink.num_bytes + len(data)
+                    syscalls[0] += send()
+                    sink.wait(done)
+                calls, secs = timeit(run_once)
+                yield result('bulk', '%s %s' % (name.split('.')[0], case),
+                             calls * len(frames), calls * len(data), secs,
+                             syscalls[0])
+    finally:
+        sink.close()
+        shutil.rmtree(cache_dir)
+
+def bench_banner():
+    text = sign.combine(sign.E, sign.A, sign.T, sign.SP, sign.J, sign.O,
+                        sign.S)
+    frames = len(text[0]) - 16
+    num_bytes = len(sign.make_banner(text))
+    calls, secs = timeit(lambda: sign.make_banner(text))
+    yield result('banner', 'EAT JOS', calls * frames, calls * num_bytes, secs)
+
+Stages = (
+    ('render', bench_render),
+    ('geometry', bench_geometry),
+    ('to_binary', bench_to_binary),
+    ('to_file', bench_to_file),
+    ('escape', bench_escape),
+    ('serial', bench_serial),
+    ('bulk', bench_bulk),
+    ('banner', bench_banner),
+)
+
+def run(stages = None):
+    r'''Runs the named stages (all of them if None), returns the results.
+    '''
+    render.Debug = False
+    render.load_lights()        # don't time loading the lights
+    ans = []
+    for name, fn in Stages:
+        if stages is None or name in stages:
+            for r in fn():
+                print_result(r)
+                ans.append(r)
+    return ans
+
+def print_header():
+    print "%-10s %-28s %10s %12s %12s %11s" % \
+            ("stage", "case", "frames/s", "bytes/s", "mSec/frame",
+             "syscalls/MB")
+
+def print_result(r):
+    print "%-10s %-28s %10.1f %12.0f %12.3f %11s" % \
+            (r['stage'], r['case'], r['frames_per_sec'], r['bytes_per_sec'],
+             1000 / r['frames_per_sec'],
+             "%.0f" % r['syscalls_per_mb'] if 'syscalls_per_mb' in r else '')
+    sys.stdout.flush()
+
+def compare(old_filename, results):
+    r'''Prints how much faster (> 1) or slower (< 1) each case is now than in
+    old_filename.
+    '''
+    with open(old_filename) as f:
+        old = dict(((r['stage'], r['case']), r)
+                   for r in json.load(f)['results'])
+    print
+    print "%-10s %-28s %10s" % ("stage", "case", "speedup")
+    for r in results:
+        before = old.get((r['stage'], r['case']))
+        if before is not None:
+            print "%-10s %-28s %10.2f" % \
+                    (r['stage'], r['case'],
+                     r['frames_per_sec'] / before['frames_per_sec'])
+
+def write_json(filename, results):
+    with open(filename, 'w') as f:
+        json.dump({'version': Version,
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'results': results,
+                  }, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+def main():
+    global Min_secs
+    parser = optparse.OptionParser(
+               usage="%prog [options] [stage...]",
+               description="stages: " + ', '.join(name for name, _ in Stages))
+    parser.add_option("-j", "--json", metavar="FILE",
+                      help="write the results to FILE as JSON")
+    parser.add_option("-c", "--compare", metavar="FILE",
+                      help="compare with the JSON results in FILE")
+    parser.add_option("-s", "--secs", type="float", default=Min_secs,
+                      help="time each case for at least SECS "
+                           "(default %default)")
+    options, args = parser.parse_args()
+    for name in args:
+        if name not in dict(Stages):
+            parser.error("unknown stage %r" % name)
+    Min_secs = options.secs
+    print_header()
+    results = run(args or None)
+    if options.json: write_json(options.json, results)
+    if options.compare: compare(options.compare, results)
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,17 @@
 
 # driver.py
 
+from __future__ import with_statement
+
 import os
 import sys
+import time
+import struct
+import hashlib
+import itertools
+import threading
+import traceback
+import collections
 
 sys.path.insert(0,
     os.path.abspath(
@@ -11,38 +20,600 @@ sys.path.insert(0,
         os.path.dirname(__file__),
         '../../tools/PC')))
 
+sys.path.insert(0,
+    os.path.abspath(
+        os.path.join(
+        os.path.dirname(__file__),
+        '../image')))
+
 from pyterm import aterm, commands
 
+import animation
+import geometry
+import render
+# render and geometry only import these when they're first needed; import
+# them now, while sys.path still has ../image (python -m doctest removes it).
+import grid
+import shape
+
 Sync_char = chr(0xD8);
 Esc_char = chr(0x27);
+Delta_char = chr(0xD9);     # first (unescaped) char of a delta frame
+
+# stationary_platform.pde has no delta decoder yet: it would show a delta
+# frame as raw data.  So the show commands refuse 'delta' until this is set.
+Firmware_delta = False
+
+Geometry = geometry.Default # of the platform that the commands talk to
 
 def escape(data):
+    r'''Escapes the special chars in data.
+
+    Delta_char only has to be escaped at the start of a frame, but it's
+    simpler to always escape it.  The Arduino takes any escaped char
+    literally, so this doesn't change what it sees.
+    '''
     return data.replace(Esc_char, Esc_char + Esc_char) \
-               .replace(Sync_char, Esc_char + Sync_char)
+               .replace(Sync_char, Esc_char + Sync_char) \
+               .replace(Delta_char, Esc_char + Delta_char)
 
-def escape_file(filename):
+def file_frames(filename, geom = geometry.Default):
+    r'''Returns a list of the frames in a raw (.bin) file.
+
+    See split_frames.
+    '''
     with open(filename) as f:
         data = f.read()
     print "file length is", len(data)
+    return split_frames(data, geom)
+
+def split_frames(data, geom = geometry.Default):
+    r'''Returns a list of the frames in `data`, the contents of a .bin file.
+
+    The frames are geom.frame_size (800) bytes.  Data shorter than that is
+    repeated to fill one frame.
 
-    if len(data) > 800:
-        assert len(data) % 800 == 0, "file length not multiple of 800"
+        >>> [len(frame) for frame in split_frames('\x01' * 1600)]
+        [800, 800]
+        >>> split_frames('\x01' * 400) == ['\x01' * 800]
+        True
+    '''
+    size = geom.frame_size
+    if len(data) > size:
+        assert len(data) % size == 0, \
+               "file length not multiple of %d" % size
 
     ans = []
-    for i in range(0, len(data), 800):
-        if len(data) - i < 800:
-            assert (len(data) - i) % 16 == 0, "file length not multiple of 16"
-            assert 800 % (len(data) - i) == 0, "800 not multiple of file length"
-            piece = (800 // (len(data) + i)) * data[i:];
-            assert len(piece) == 800
+    for i in range(0, len(data), size):
+        if len(data) - i < size:
+            assert (len(data) - i) % geom.page_bytes == 0, \
+                   "file length not multiple of %d" % geom.page_bytes
+            assert size % (len(data) - i) == 0, \
+                   "%d not multiple of file length" % size
+            piece = (size // (len(data) + i)) * data[i:];
+            assert len(piece) == size
         else:
-            piece = data[i:i+800]
-        ans.append(Sync_char + escape(piece))
+            piece = data[i:i+size]
+        ans.append(piece)
+    return ans
 
-    data = ''.join(ans)
+def escape_file(filename, geom = geometry.Default, cache = None):
+    r'''Returns the escaped frames of a raw (.bin) file, ready to send.
+
+    If an escape_cache is given, the frames are only escaped if they aren't
+    already in it.
+    '''
+    if cache is None:
+        data = ''.join(escape_frames(file_frames(filename, geom)))
+    else:
+        data = cache.escape_file(filename, geom)
     print "escaped length is", len(data)
     return data
 
+class escape_cache(object):
+    r'''A cache on disk of the escaped frames of .bin files.
+
+    The escaped data is kept in `directory`, named by the sha1 of the file's
+    contents and of everything that the escaping depends on (the special
+    chars and the geometry).  So an edited file is simply a new entry, and
+    no entry can be used with the wrong parameters.
+
+    Each entry holds the number of frames and their escaped lengths (as
+    Lengths), followed by the escaped frames, so that they can be sent one
+    at a time without escaping them again.
+
+    Entries are touched when used, and the least recently used are removed
+    once the cache holds more than `max_bytes`.
+
+    The last `max_recent` entries used are also kept in memory, and the
+    sha1 of each file is remembered by its size and mtime, so playing the
+    same file again doesn't even read it.
+
+        >>> import tempfile
+        >>> cache = escape_cache(tempfile.mkdtemp(), max_bytes = 2000)
+        >>> a = cache.escape(Sync_char * 800)
+        >>> len(a), cache.escape(Sync_char * 800) == a, cache.hits, cache.misses
+        (1601, True, 1, 1)
+        >>> [len(frame) for frame in cache.escaped_frames('\x00' * 1600)]
+        [801, 801]
+        >>> b = cache.escape('\x00' * 800)
+        >>> len(os.listdir(cache.directory))
+        1
+        >>> b = cache.escape('\x00' * 800)
+        >>> cache.hits, cache.misses
+        (2, 3)
+
+    A truncated entry is escaped again:
+
+        >>> name = os.listdir(cache.directory)[0]
+        >>> open(os.path.join(cache.directory, name), 'wb').close()
+        >>> cache = escape_cache(cache.directory, max_bytes = 2000)
+        >>> len(cache.escape('\x00' * 800)), cache.hits, cache.misses
+        (801, 0, 1)
+        >>> os.path.getsize(os.path.join(cache.directory, name))
+        809
+    '''
+    Version = 1     # change this when escaping changes
+
+    Lengths = struct.Struct('<I')
+
+    def __init__(self, directory = os.path.join(geometry.Cache_dir,
+                                                'escaped'),
+                 max_bytes = 64 << 20, max_recent = 4):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_recent = max_recent
+        self.recent = collections.OrderedDict()    # {key: (frames, str)}
+        self.keys = {}      # {(path, size, mtime, geom params): key}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, data, geom = geometry.Default):
+        params = (self.Version, Sync_char, Esc_char, Delta_char,
+                  geom.frame_size, geom.page_bytes)
+        h = hashlib.sha1(repr(params))
+        h.update(data)
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.esc')
+
+    def escape_file(self, filename, geom = geometry.Default):
+        return self.file_entry(filename, geom)[1]
+
+    def escaped_file_frames(self, filename, geom = geometry.Default):
+        return self.file_entry(filename, geom)[0]
+
+    def escape(self, data, geom = geometry.Default):
+        r'''Returns the escaped frames of `data` (the contents of a .bin
+        file) as one str.
+        '''
+        return self.entry(self.key(data, geom), lambda: data, geom)[1]
+
+    def escaped_frames(self, data, geom = geometry.Default):
+        r'''Returns a list of the escaped frames of `data`.
+        '''
+        return self.entry(self.key(data, geom), lambda: data, geom)[0]
+
+    def file_entry(self, filename, geom):
+        def read():
+            with open(filename, 'rb') as f:
+                return f.read()
+        st = os.stat(filename)
+        stamp = (os.path.abspath(filename), st.st_size, st.st_mtime,
+                 geom.params())
+        key = self.keys.get(stamp)
+        if key is None:
+            data = read()
+            key = self.keys[stamp] = self.key(data, geom)
+            return self.entry(key, lambda: data, geom)
+        return self.entry(key, read, geom)
+
+    def entry(self, key, get_data, geom):
+        r'''Returns (escaped frames, joined) for `key`.
+
+        Only calls get_data(), and escapes it, if `key` isn't cached.
+        '''
+        ans = self.recent.pop(key, None)
+        if ans is None:
+            frames = self.load(self.filename(key))
+            if frames is None:
+                self.misses += 1
+                frames = list(escape_frames(split_frames(get_data(), geom)))
+                self.save(self.filename(key), frames)
+            else:
+                self.hits += 1
+            ans = frames, ''.join(frames)
+        else:
+            self.hits += 1
+        self.recent[key] = ans
+        while len(self.recent) > self.max_recent:
+            self.recent.popitem(last=False)
+        return ans
+
+    def load(self, filename):
+        r'''Returns the frames saved in `filename`, or None.
+
+        A truncated or corrupt file also gives None, so that the frames are
+        escaped again (and saved over it).
+        '''
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        size = self.Lengths.size
+        try:
+            num_frames, = self.Lengths.unpack_from(data)
+            pos = size * (num_frames + 1)
+            frames = []
+            for i in xrange(1, num_frames + 1):
+                length, = self.Lengths.unpack_from(data, i * size)
+                frames.append(data[pos:pos + length])
+                pos += length
+        except struct.error:
+            return None
+        if pos != len(data): return None
+        return frames
+
+    def save(self, filename, frames):
+        r'''Saves `frames` in `filename`, if possible, then evicts.
+        '''
+        temp = None
+        try:
+            if not os.path.isdir(self.directory): os.makedirs(self.directory)
+            temp = '%s.%d' % (filename, os.getpid())
+            with open(temp, 'wb') as f:
+                f.write(self.Lengths.pack(len(frames)))
+                for frame in frames:
+                    f.write(self.Lengths.pack(len(frame)))
+                f.writelines(frames)
+            os.rename(temp, filename)
+            temp = None
+            self.evict(keep = os.path.basename(filename))
+        except (IOError, OSError):
+            # evict only sees the .esc files, so don't leave the temp file
+            if temp is not None:
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+
+    def evict(self, keep = None):
+        r'''Removes the least recently used entries (other than `keep`)
+        while over max_bytes.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.esc'):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, name, st.st_size))
+        entries.sort()
+        total = sum(size for _, _, size in entries)
+        for _, name, size in entries:
+            if total <= self.max_bytes: break
+            if name != keep:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+
+Escape_cache = escape_cache()   # used by the show commands
+
+def escape_frames(frames):
+    r'''Generates the escaped frames, each with its leading Sync_char.
+
+        >>> list(escape_frames(('a' + Sync_char, Esc_char + 'b')))
+        ["\xd8a'\xd8", "\xd8''b"]
+    '''
+    for frame in frames:
+        yield Sync_char + escape(str(frame))
+
+class delta_encoder(object):
+    r'''Encodes frames as keyframes and XOR deltas against the last frame.
+
+    A keyframe is sent just as escape_frames does: Sync_char followed by the
+    escaped frame.  A delta frame is Sync_char, an unescaped Delta_char
+    and then the escaped delta.  The delta is a series of runs, each:
+
+        skip    (1 byte) number of unchanged bytes before this run
+        count   (1 byte) number of bytes in this run
+        xors    (count bytes) what to XOR into the last frame
+
+    A skip longer than 255 is sent as runs with a count of 0.  Changed bytes
+    close together are sent as one run, since that's shorter than starting
+    a new run.
+
+    A keyframe is sent for the first frame, then every `keyframe_interval`
+    frames (so that the display recovers from lost bytes), and whenever the
+    delta would be longer than the keyframe.
+
+    frame_decoder is the reference decoder for this.  The sketches can't
+    decode delta frames yet (see Firmware_delta).
+
+        >>> e = delta_encoder()
+        >>> key = e.encode('\x00' * 800)
+        >>> len(key)
+        801
+        >>> d = e.encode('\x00' * 10 + '\x01\x00\x02' + '\x00' * 787)
+        >>> d == Sync_char + Delta_char + '\x0a\x03\x01\x00\x02'
+        True
+        >>> e.encode('\x00' * 10 + '\x01\x00\x02' + '\x00' * 787) \
+        ...   == Sync_char + Delta_char
+        True
+        >>> e.encode('\xff' * 800) == Sync_char + '\xff' * 800
+        True
+    '''
+    run_gap = 2     # unchanged bytes that cost less than a new run
+
+    def __init__(self, keyframe_interval = 50):
+        self.keyframe_interval = keyframe_interval
+        self.last_frame = None
+        self.frames_since_key = 0
+
+    def encode(self, frame):
+        frame = bytearray(frame)
+        key = Sync_char + escape(str(frame))
+        if self.last_frame is not None and \
+           self.frames_since_key + 1 < self.keyframe_interval:
+            delta = Sync_char + Delta_char + escape(self.delta(frame))
+            if len(delta) < len(key):
+                self.last_frame = frame
+                self.frames_since_key += 1
+                return delta
+        self.last_frame = frame
+        self.frames_since_key = 0
+        return key
+
+    def delta(self, frame):
+        r'''Returns the (unescaped) runs from self.last_frame to frame.
+        '''
+        last = self.last_frame
+        changed = [i for i in xrange(len(frame)) if frame[i] != last[i]]
+        ans = bytearray()
+        pos = 0             # first byte not yet covered by a run
+        i = 0
+        while i < len(changed):
+            start = end = changed[i]
+            i += 1
+            while i < len(changed) and changed[i] - end <= self.run_gap + 1 \
+                  and changed[i] - start < 255:
+                end = changed[i]
+                i += 1
+            skip = start - pos
+            while skip > 255:
+                ans += chr(255) + chr(0)
+                skip -= 255
+            ans.append(skip)
+            ans.append(end + 1 - start)
+            ans += bytearray(frame[j] ^ last[j] for j in xrange(start, end + 1))
+            pos = end + 1
+        return str(ans)
+
+    def encode_frames(self, frames):
+        for frame in frames:
+            yield self.encode(frame)
+
+class frame_decoder(object):
+    r'''Reference decoder for what escape_frames and delta_encoder send.
+
+    This is only a reference, for testing the encoders: it's what a sketch
+    would have to do, byte by byte, to take delta frames.  It unescapes,
+    starts a new frame on each unescaped Sync_char, and treats an unescaped
+    Delta_char right after the Sync_char as the start of a delta frame.
+    stationary_platform.pde does the first two, but has no delta decoding
+    (see Firmware_delta).
+
+    A frame is complete when the next Sync_char arrives (or on flush).
+    Keyframes must be geom.frame_size bytes.
+
+        >>> frames = ['\x00' * 800, '\x00' * 5 + Sync_char + '\x00' * 794,
+        ...           Esc_char + Delta_char + '\x00' * 798,
+        ...           Delta_char + '\x00' * 700 + '\x01' * 99]
+        >>> wire = ''.join(delta_encoder().encode_frames(frames))
+        >>> len(wire) < 4 * 801
+        True
+        >>> d = frame_decoder()
+        >>> decoded = list(d.feed(wire)) + list(d.flush())
+        >>> decoded == frames
+        True
+        >>> d.errors
+        0
+    '''
+    def __init__(self, geom = geometry.Default):
+        self.frame_size = geom.frame_size
+        self.frame = bytearray(self.frame_size)
+        self.data = None            # unescaped bytes since the last sync
+        self.is_delta = False
+        self.escape_next = False
+        self.errors = 0
+
+    def feed(self, wire):
+        r'''Generates each frame completed by the bytes in `wire`.
+        '''
+        for c in wire:
+            if self.escape_next:
+                self.escape_next = False
+                if self.data is not None: self.data.append(c)
+            elif c == Esc_char:
+                self.escape_next = True
+            elif c == Sync_char:
+                frame = self.end_frame()
+                if frame is not None: yield frame
+                self.data = bytearray()
+                self.is_delta = False
+            elif c == Delta_char and self.data is not None and not self.data \
+                 and not self.is_delta:
+                self.is_delta = True
+            elif self.data is not None:
+                self.data.append(c)
+
+    def flush(self):
+        frame = self.end_frame()
+        self.data = None
+        if frame is not None: yield frame
+
+    def end_frame(self):
+        r'''Applies the data since the last sync, returns the frame as a str.
+        '''
+        data = self.data
+        if data is None: return None
+        if not self.is_delta:
+            if len(data) != self.frame_size:
+                self.errors += 1
+                return None
+            self.frame[:] = data
+            return str(self.frame)
+        pos = i = 0
+        while i + 2 <= len(data):
+            pos += data[i]
+            count = data[i + 1]
+            i += 2
+            if i + count > len(data) or pos + count > self.frame_size:
+                self.errors += 1
+                return None
+            for j in xrange(count):
+                self.frame[pos + j] ^= data[i + j]
+            pos += count
+            i += count
+        if i != len(data):
+            self.errors += 1
+            return None
+        return str(self.frame)
+
+class pacer(object):
+    r'''Paces the frames sent to the platform using its telemetry.
+
+    The platform shows at most one new frame per revolution, so frames are
+    never sent faster than the mSec/rev from its last RPS report.  Above
+    that, the interval between frames is adjusted by AIMD: it shrinks by
+    `step` secs on each RPS report, and on each error report without
+    Incomplete_bufs or Buf_overflows since the last one; otherwise it is
+    multiplied by `backoff` (up to `max_interval`).  (The platform only
+    sends error reports when print_errors is enabled, so the RPS reports
+    are what speed it up.)
+
+    rps and errors are called (from the usb thread) by format_rps and
+    format_errors; wait is called before sending each frame.
+
+        >>> now = [0.0]
+        >>> p = pacer(interval = 0.1, clock = lambda: now[0],
+        ...           sleep = lambda secs: now.__setitem__(0, now[0] + secs))
+        >>> p.wait(); p.wait(); now[0]
+        0.1
+        >>> p.errors(0, 0, 0, 0); p.interval
+        0.098
+        >>> p.errors(1, 0, 0, 2); p.interval
+        0.147
+        >>> p.rps(200.0); p.interval
+        0.2
+        >>> p.errors(0, 0, 0, 0); p.interval
+        0.2
+        >>> p.rps(50.0); p.interval
+        0.198
+    '''
+    def __init__(self, interval = 0.1, step = 0.002, backoff = 1.5,
+                 max_interval = 2.0, clock = time.time, sleep = time.sleep):
+        self.interval = interval        # secs between frames
+        self.step = step
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.min_interval = 0.0         # secs/rev, once known
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.next_time = None
+        self.frames = 0
+        self.error_reports = 0
+        self.backoffs = 0
+        self.errors_seen = collections.Counter()
+
+    def rps(self, msec_per_rev):
+        with self.lock:
+            self.min_interval = msec_per_rev / 1000.0
+            self.interval = max(self.min_interval,
+                                round(self.interval - self.step, 6))
+
+    def errors(self, incomplete_bufs, framing_errors, data_overruns,
+               buf_overflows):
+        with self.lock:
+            self.error_reports += 1
+            self.errors_seen.update(incomplete_bufs = incomplete_bufs,
+                                    framing_errors = framing_errors,
+                                    data_overruns = data_overruns,
+                                    buf_overflows = buf_overflows)
+            if incomplete_bufs or buf_overflows:
+                self.backoffs += 1
+                self.interval = min(self.max_interval,
+                                    round(self.interval * self.backoff, 6))
+            else:
+                self.interval = max(self.min_interval,
+                                    round(self.interval - self.step, 6))
+
+    def wait(self):
+        r'''Waits until the next frame is due.
+        '''
+        now = self.clock()
+        if self.next_time is not None and self.next_time > now:
+            self.sleep(self.next_time - now)
+            now = self.next_time
+        with self.lock:
+            self.next_time = now + self.interval
+        self.frames += 1
+
+    def fps(self):
+        return 1.0 / self.interval if self.interval else float('inf')
+
+    def report(self):
+        return "pacing: %.1f frames/sec (%.1f mSec, %.1f mSec/rev), " \
+               "%d frames, %d of %d error reports backed off%s\n" % \
+                 (self.fps(), self.interval * 1000, self.min_interval * 1000,
+                  self.frames, self.backoffs, self.error_reports,
+                  ''.join(", %s=%d" % item
+                          for item in sorted(self.errors_seen.items())))
+
+Pacer = pacer()     # fed by the format strings, used by the show commands
+
+def show_frames(arduino, frames, delta = False, pacer = None):
+    r'''Sends the frames to the arduino one at a time.
+
+    With `delta`, frames are sent through a delta_encoder.  If a `pacer` is
+    given, it decides when each frame is sent.
+    '''
+    if delta:
+        wire = delta_encoder().encode_frames(frames)
+    else:
+        wire = escape_frames(frames)
+    send_wire(arduino, wire, pacer)
+
+def send_wire(arduino, wire, pacer = None):
+    r'''Writes each already encoded frame in `wire` to the arduino.
+
+    Unpaced frames are written together (see comm.write_frames) if the
+    arduino can.
+    '''
+    if pacer is None and hasattr(arduino, 'write_frames'):
+        arduino.write_frames(wire)
+        return
+    for data in wire:
+        if pacer is not None: pacer.wait()
+        arduino.write(data)
+
+def show_animation(arduino, filename, forever = False, delta = False,
+                   geom = geometry.Default, pacer = None):
+    r'''Streams an animation file to the arduino one frame at a time.
+
+    The frames are read through an mmap, so this runs in constant memory no
+    matter how long the animation is.  The animation must have been made
+    for `geom`.
+    '''
+    with animation.reader(filename) as frames:
+        if frames.frame_size != geom.frame_size:
+            raise ValueError("%s: %d byte frames, expected %d" %
+                               (filename, frames.frame_size, geom.frame_size))
+        if forever:
+            frames = itertools.chain.from_iterable(itertools.repeat(frames))
+        show_frames(arduino, frames, delta, pacer)
+
 def file_once(filename, devnum = 0):
     data = escape_file(filename)
     with comm.osclosing(comm.open(devnum, **kws)) as f:
@@ -52,26 +623,387 @@ def repeat_file(filename, devnum = 0):
     data = escape_file(filename)
     comm.repeat(devnum, data, crtscts = True)
 
-@commands.command("%(name)s filename")
-def show_once(output, close_output, arduino, filename):
+def delta_refused(encoding):
+    r'''Writes an error and returns True if `encoding` is 'delta' and the
+    sketch can't take it (see Firmware_delta).
+    '''
+    if encoding == 'delta' and not Firmware_delta:
+        sys.stderr.write("Error: delta encoding isn't supported by the "
+                         "stationary_platform sketch\n")
+        return True
+    return False
+
+@commands.command("%(name)s filename [delta]")
+def show_once(output, close_output, arduino, filename, encoding = 'full'):
     try:
-        data = escape_file(filename)
-        arduino.write(data)
+        if delta_refused(encoding): return
+        delta = encoding == 'delta'
+        if animation.is_animation(filename):
+            show_animation(arduino, filename, delta = delta, geom = Geometry)
+        elif delta:
+            show_frames(arduino, file_frames(filename, Geometry), delta)
+        else:
+            data = escape_file(filename, Geometry, Escape_cache)
+            arduino.write(data)
     finally:
         if close_output: output.close()
 
-@commands.command("%(name)s filename")
-def show_forever(output, close_output, arduino, filename):
+@commands.command("%(name)s filename [full|delta] [unpaced|paced]")
+def show_forever(output, close_output, arduino, filename, encoding = 'full',
+                 pacing = 'unpaced'):
+    r'''Sends the file over and over.
+
+    If 'paced', the frames are paced by Pacer to the rotation rate and error
+    counts reported by the platform.  Unpaced (the default), they're sent as
+    fast as the link will take them.
+    '''
     try:
-        data = escape_file(filename)
-        while True:
-            arduino.write(data)
+        if delta_refused(encoding): return
+        delta = encoding == 'delta'
+        pacer = Pacer if pacing == 'paced' else None
+        if animation.is_animation(filename):
+            show_animation(arduino, filename, forever = True, delta = delta,
+                           geom = Geometry, pacer = pacer)
+        elif delta:
+            frames = file_frames(filename, Geometry)
+            show_frames(arduino,
+                        itertools.chain.from_iterable(itertools.repeat(frames)),
+                        delta, pacer)
+        elif pacer is not None:
+            wire = Escape_cache.escaped_file_frames(filename, Geometry)
+            send_wire(arduino,
+                      itertools.chain.from_iterable(itertools.repeat(wire)),
+                      pacer)
+        else:
+            data = escape_file(filename, Geometry, Escape_cache)
+            while True:
+                arduino.write(data)
+    finally:
+        if close_output: output.close()
+
+@commands.command("%(name)s")
+def pacing(output, close_output, arduino):
+    try:
+        output.write(Pacer.report())
+    finally:
+        if close_output: output.close()
+
+class frame_queue(object):
+    r'''A bounded queue between two stages of a live_stream.
+
+    When the queue is full, put either drops the oldest item in the queue
+    ('drop_oldest', so that the display is as current as possible), drops
+    the new item ('drop_newest', so that the work already queued isn't
+    wasted) or waits for room ('block').
+
+    get returns None once the queue is closed and empty.
+
+        >>> q = frame_queue(2, 'drop_oldest')
+        >>> for i in range(4): q.put(i)
+        >>> q.get(), q.get(), q.dropped
+        (2, 3, 2)
+        >>> q = frame_queue(2, 'drop_newest')
+        >>> for i in range(4): q.put(i)
+        >>> q.close()
+        >>> q.get(), q.get(), q.get(), q.dropped, q.max_depth
+        (0, 1, None, 2, 2)
+    '''
+    Policies = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, maxsize = 4, policy = 'drop_oldest'):
+        assert policy in self.Policies, \
+               "frame_queue: unknown policy %r" % (policy,)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.puts = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.depth_total = 0    # depth after each put, for mean_depth
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return
+                if self.policy == 'drop_oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.items) >= self.maxsize and not self.closed:
+                        self.cond.wait()
+                    if self.closed: return
+            self.items.append(item)
+            self.puts += 1
+            self.depth_total += len(self.items)
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if not self.items: return None
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def mean_depth(self):
+        return float(self.depth_total) / self.puts if self.puts else 0.0
+
+    def report(self, name):
+        return "%s queue: depth %d (mean %.1f, max %d of %d), %d dropped" % \
+                 (name, len(self), self.mean_depth(), self.max_depth,
+                  self.maxsize, self.dropped)
+
+class stage_timer(object):
+    r'''Times each frame through one stage of a live_stream.
+
+        >>> t = stage_timer('render')
+        >>> t.add(0.002); t.add(0.004)
+        >>> print t.report()
+        render: 2 frames, 3.00 mSec avg, 4.00 max
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, secs):
+        self.count += 1
+        self.total += secs
+        self.max = max(self.max, secs)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def report(self):
+        return "%s: %d frames, %.2f mSec avg, %.2f max" % \
+                 (self.name, self.count, self.mean() * 1000, self.max * 1000)
+
+class live_stream(object):
+    r'''Renders frames, escapes them and sends them to the arduino as they
+    are made.
+
+    scene_fn(frame_number) returns the shapes for each frame (None ends the
+    stream).  Each of the three stages runs in its own thread, with a
+    frame_queue of `queue_size` between the stages, using `policy` when the
+    next stage falls behind.  Delta frames only make sense in order, so with
+    `delta` the queue after the escape stage always blocks rather than drops.
+
+    If `fps` is given, frames are rendered no faster than that.  If a
+    `pacer` is given, it decides when each frame is written.
+
+    report() gives the time spent in each stage, the latency from the start
+    of rendering to the end of the write, and the queue depths; this is also
+    written to `output` every `report_secs`.  `output` is closed by stop if
+    `close_output`.
+
+        >>> import StringIO
+        >>> class fake_arduino(object):
+        ...     def __init__(self): self.wire = []
+        ...     def write(self, s): self.wire.append(s)
+        >>> def scene_fn(frame_number):
+        ...     if frame_number < 3: return ()
+        >>> arduino = fake_arduino()
+        >>> s = live_stream(arduino, scene_fn, policy = 'block')
+        >>> s.start(); s.wait()
+        >>> len(arduino.wire), arduino.wire[0] == Sync_char + '\x00' * 800
+        (3, True)
+        >>> s.timers['write'].count
+        3
+    '''
+    def __init__(self, arduino, scene_fn, queue_size = 4,
+                 policy = 'drop_oldest', delta = False, fps = None,
+                 geom = geometry.Default, output = None, close_output = False,
+                 report_secs = 5.0, pacer = None):
+        self.arduino = arduino
+        self.pacer = pacer
+        self.scene_fn = scene_fn
+        self.delta = delta
+        self.fps = fps
+        self.geom = geom
+        self.output = output
+        self.close_output = close_output
+        self.report_secs = report_secs
+        self.rendered = frame_queue(queue_size, policy)
+        self.escaped = frame_queue(queue_size, 'block' if delta else policy)
+        self.timers = dict((name, stage_timer(name))
+                           for name in ('render', 'escape', 'write',
+                                        'latency'))
+        self.stopped = False
+        self.threads = [threading.Thread(target=fn, name=name)
+                        for name, fn in (("live_render", self.render_loop),
+                                         ("live_escape", self.escape_loop),
+                                         ("live_write", self.write_loop))]
+        for t in self.threads: t.setDaemon(True)
+
+    def start(self):
+        for t in self.threads: t.start()
+
+    def stop(self):
+        self.stopped = True
+        self.rendered.close()
+        self.escaped.close()
+        self.wait()
+        if self.close_output: self.output.close()
+
+    def wait(self):
+        for t in self.threads: t.join()
+
+    def render_loop(self):
+        try:
+            frame_number = 0
+            next_time = time.time()
+            while not self.stopped:
+                start = time.time()
+                shapes = self.scene_fn(frame_number)
+                if shapes is None: break
+                # printing every frame would swamp the link
+                data = str(render.frame(*shapes, geom = self.geom,
+                                        debug = False).buffer)
+                self.timers['render'].add(time.time() - start)
+                self.rendered.put((start, data))
+                frame_number += 1
+                if self.fps:
+                    next_time += 1.0 / self.fps
+                    delay = next_time - time.time()
+                    if delay > 0: time.sleep(delay)
+                    else: next_time -= delay    # don't try to catch up
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.rendered.close()
+
+    def escape_loop(self):
+        try:
+            if self.delta:
+                encode = delta_encoder().encode
+            else:
+                encode = lambda frame: Sync_char + escape(frame)
+            while True:
+                item = self.rendered.get()
+                if item is None: break
+                born, frame = item
+                start = time.time()
+                wire = encode(frame)
+                self.timers['escape'].add(time.time() - start)
+                self.escaped.put((born, wire))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.escaped.close()
+
+    def write_loop(self):
+        try:
+            last_report = time.time()
+            while True:
+                item = self.escaped.get()
+                if item is None: break
+                born, wire = item
+                if self.pacer is not None: self.pacer.wait()
+                start = time.time()
+                self.arduino.write(wire)
+                end = time.time()
+                self.timers['write'].add(end - start)
+                self.timers['latency'].add(end - born)
+                if self.output is not None and \
+                   end - last_report >= self.report_secs:
+                    self.output.write(self.report())
+                    last_report = end
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.stopped = True
+            self.rendered.close()
+
+    def bottleneck(self):
+        r'''Which of 'the renderer' or 'the link' is slowest, going by the
+        mean stage times.
+        '''
+        if self.timers['render'].mean() + self.timers['escape'].mean() > \
+           self.timers['write'].mean():
+            return "the renderer"
+        return "the link"
+
+    def report(self):
+        return ''.join(line + '\n' for line in
+                         [self.timers[name].report()
+                          for name in ('render', 'escape', 'write',
+                                       'latency')] +
+                         [self.rendered.report('rendered'),
+                          self.escaped.report('escaped'),
+                          "bottleneck: " + self.bottleneck()]) + \
+               (self.pacer.report() if self.pacer is not None else '')
+
+def load_scene_fn(name):
+    r'''Imports the "module.function" `name`.
+    '''
+    module_name, fn_name = name.rsplit('.', 1)
+    return getattr(__import__(module_name), fn_name)
+
+Live = None         # the live_stream started by show_live
+
+@commands.command("%(name)s module.function [drop_oldest|drop_newest|block] "
+                  "[delta]")
+def show_live(output, close_output, arduino, scene_fn_name,
+              policy = 'drop_oldest', encoding = 'full'):
+    r'''Starts a live_stream, leaving it running in the background.
+
+    module.function is called with the Geometry, and returns the scene_fn.
+    The stream reports to `output` until stopped with stop_live.
+    '''
+    global Live
+    if Live is not None:
+        sys.stderr.write("Error: show_live already running, stop_live first\n")
+        if close_output: output.close()
+        return
+    if delta_refused(encoding):
+        if close_output: output.close()
+        return
+    try:
+        scene_fn = load_scene_fn(scene_fn_name)(Geometry)
+        Live = live_stream(arduino, scene_fn, policy = policy,
+                           delta = encoding == 'delta', geom = Geometry,
+                           output = output, close_output = close_output,
+                           pacer = Pacer)
+        Live.start()
+    except BaseException:
+        Live = None
+        if close_output: output.close()
+        raise
+
+@commands.command("%(name)s")
+def stop_live(output, close_output, arduino):
+    global Live
+    try:
+        if Live is not None:
+            Live.stop()
+            output.write(Live.report())
+            Live = None
     finally:
         if close_output: output.close()
 
 Commands = {
     "show_once": show_once,
     "show_forever": show_forever,
+    "show_live": show_live,
+    "stop_live": stop_live,
+    "pacing": pacing,
+    "stats": commands.stats,
+    "capture": commands.capture,
     "help": commands.help,
 }
 
@@ -81,27 +1013,53 @@ commands.Commands = Commands
 class format_rps(aterm.format_string):
     def fix_args(self, args):
         r'''args[0] is timer1 ticks/rev @ 4uSec/tick.
+
+        Also passes the mSec/rev on to Pacer.
         '''
+        Pacer.rps(args[0]/250.0)
         return (250000.0/args[0], args[0]/250.0)
 
-Format_strings = {
-    1: aterm.format_string("stationary_platform: %x, %x\n",
-                           ('unsigned', 1),
-                           ('unsigned', 2)),
-    2: aterm.format_string(
-         "Incomplete_bufs=%d@%d, FE=%d@%d, DOR=%d@%d, Buf_overflows=%d@%d\n",
-                           ('unsigned', 1),
-                           ('unsigned', 1),
-                           ('unsigned', 1),
-                           ('unsigned', 1),
-                           ('unsigned', 1),
-                           ('unsigned', 1),
-                           ('unsigned', 2),
-                           ('unsigned', 1)),
-    3: format_rps("RPS=%.1f, mSec/rev=%.1f\n", ('unsigned', 2)),
-}
+class format_errors(aterm.format_string):
+    def fix_args(self, args):
+        r'''args are each count followed by where it was last seen.
+
+        Also passes the counts on to Pacer.
+        '''
+        Pacer.errors(args[0], args[2], args[4], args[6])
+        return tuple(args)
+
+# The messages the stationary_platform sketch sends.  The sketch's ids and
+# sizes are generated from this into its messages.h (run with --c-header).
+Messages = aterm.message_schema('stationary_platform',
+    ('WELCOME', 1,
+     aterm.format_string("stationary_platform: %x, %x\n",
+                         ('unsigned', 1, 'byte test'),
+                         ('unsigned', 2, 'int test'))),
+    ('ERROR_COUNT', 2,
+     format_errors(
+       "Incomplete_bufs=%d@%d, FE=%d@%d, DOR=%d@%d, Buf_overflows=%d@%d\n",
+                   ('unsigned', 1, 'Incomplete_bufs'),
+                   ('unsigned', 1, 'Where_incomplete'),
+                   ('unsigned', 1, 'Framing_errors'),
+                   ('unsigned', 1, 'Where_framing_error'),
+                   ('unsigned', 1, 'Data_overrun_errors'),
+                   ('unsigned', 1, 'Where_data_overrun'),
+                   ('unsigned', 2, 'Buf_overflows'),
+                   ('unsigned', 1, 'Where_overflow'))),
+    ('RPS', 3,
+     format_rps("RPS=%.1f, mSec/rev=%.1f\n", ('unsigned', 2, 'TCNT1'))),
+)
+
+Format_strings = Messages.format_strings()
+
+C_header = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'sketchbook', 'stationary_platform',
+                        'messages.h')
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ['--c-header']:
+        Messages.write_c_header(C_header)
+        sys.exit(0)
     aterm.run(baud = '500000', timeout = 0, crtscts = True,
               commands = Commands, format_strings = Format_strings)
 
@@ -1,7 +1,17 @@
 # sign.py
 
+import os
+import sys
 import itertools
 
+sys.path.insert(0,
+    os.path.abspath(
+        os.path.join(
+        os.path.dirname(__file__),
+        '../image')))
+
+import geometry
+
 s = (
     "  XXX  X  XXX   ",
     "  X   X X  X    ",
@@ -162,19 +172,22 @@ def makenum(column):
     '''
     return int(''.join(('0' if c == ' ' else '1') for c in column), 2)
 
-def make_pages(s, start = 0):
-    r'''Returns two sets of 8 16-bit ints for the left and right pages.
+def make_pages(s, start = 0, geom = geometry.Default):
+    r'''Returns two sets of geom.radii ints for the left and right pages.
+
+    These are 8 16-bit ints for the default geometry.
 
         >>> make_pages(("XX  XX  XX  XX  ", "                "))
         ((2, 2, 0, 0, 2, 2, 0, 0), (0, 0, 2, 2, 0, 0, 2, 2))
     '''
-    columns = tuple(makenum(column) for column in zip(*s)[start:start+16])
-    left_page = columns[:8]
-    right_page = columns[15:7:-1]
+    width = 2 * geom.radii
+    columns = tuple(makenum(column) for column in zip(*s)[start:start+width])
+    left_page = columns[:geom.radii]
+    right_page = columns[width-1:geom.radii-1:-1]
     return left_page, right_page
 
-def convert_page(page):
-    r'''A page is made up of 8 16-bit ints.
+def convert_page(page, geom = geometry.Default):
+    r'''A page is made up of geom.radii geom.levels-bit ints.
 
     Returns a string containing the binary data.
 
@@ -182,16 +195,28 @@ def convert_page(page):
         ...               0x4E4D, 0x504F))
         'ABCDEFGHIJKLMNOP'
     '''
-    return ''.join(itertools.chain(*tuple((chr(i & 0xff), chr(i >> 8))
-                                          for i in page)))
+    return ''.join(chr((i >> shift) & 0xff)
+                   for i in page
+                   for shift in range(0, geom.levels, 8))
 
-def make_sign(s, start = 0):
-    left_page, right_page = tuple(convert_page(p) for p in make_pages(s, start))
-    zero_page = chr(0) * 16
-    return left_page + zero_page * 24 + right_page + zero_page * 24
+def make_sign(s, start = 0, geom = geometry.Default):
+    r'''Shows s at two opposite steps, with the other pages left blank.
+
+        >>> big = geometry.geometry(100, 16, 32)
+        >>> big_s = tuple(line * 2 for line in s * 2)
+        >>> len(make_sign(s)), len(make_sign(big_s, geom = big))
+        (800, 6400)
+    '''
+    left_page, right_page = tuple(convert_page(p, geom)
+                                  for p in make_pages(s, start, geom))
+    zero_page = chr(0) * geom.page_bytes
+    half = geom.steps // 2
+    return left_page + zero_page * (half - 1) + \
+           right_page + zero_page * (geom.steps - half - 1)
 
 def combine(*chars):
     return tuple(''.join(lines) for lines in zip(*chars))
 
-def make_banner(s, inc = 1):
-    return ''.join(make_sign(s, i) for i in range(0, len(s[0])-16, inc))
+def make_banner(s, inc = 1, geom = geometry.Default):
+    return ''.join(make_sign(s, i, geom)
+                   for i in range(0, len(s[0]) - 2 * geom.radii, inc))
@@ -0,0 +1,220 @@
+# animation.py
+
+r'''Indexed animation files.
+
+An animation file is laid out as:
+
+    header      Header (see below), 32 bytes
+    frames      the frames, one after another
+    index       one Index_entry (offset, length) per frame
+
+The header has:
+
+    magic       Magic
+    version     Version
+    steps       angular steps per revolution (50 by default)
+    radii       lights per step at each height (8)
+    levels      heights (16)
+    frame_size  bytes in a full frame (800)
+    num_frames  number of frames
+    fps         frames per second to play the animation at
+    index       file offset of the index
+
+steps, radii and levels are the dimensions of the geometry.geometry the
+frames were rendered for.  Its first_offset isn't stored, so reader.geom
+always has the default first_offset.
+
+The writer buffers its output and only writes the index (and fills in the
+header) when it's closed.  The reader mmaps the file so that any frame can
+be read without loading the rest of the file.
+'''
+
+from __future__ import with_statement
+
+import os
+import mmap
+import struct
+
+import geometry
+
+Magic = 'TBL3'
+Version = 1
+
+Header = struct.Struct('<4sHHHHIIfQ')
+Index_entry = struct.Struct('<QI')
+
+def is_animation(filename):
+    r'''True if `filename` is an animation file (rather than raw frames).
+    '''
+    with open(filename, 'rb') as f:
+        return f.read(len(Magic)) == Magic
+
+class writer(object):
+    r'''Writes frames to a new animation file.
+
+    Frames may be anything that can be written to a file (str, bytearray,
+    buffer); a render.frame_buffer is written from its memoryview.  Each
+    frame must be frame_size bytes long, or ValueError is raised.  These
+    can be used as context managers.
+
+        >>> import os, tempfile
+        >>> filename = os.path.join(tempfile.mkdtemp(), 'test.anim')
+        >>> with writer(filename, fps = 20) as w:
+        ...     w.write_frame('\x01' * 800)
+        ...     w.write_frame(bytearray('\x02' * 800))
+        >>> r = reader(filename)
+        >>> len(r), r.fps, r.frame_size, r.geom == geometry.Default
+        (2, 20.0, 800, True)
+        >>> str(r[1][:4])
+        '\x02\x02\x02\x02'
+        >>> [str(frame[:1]) for frame in r]
+        ['\x01', '\x02']
+        >>> r.close()
+        >>> with writer(filename) as w:
+        ...     w.write_frame('\x01' * 799)
+        Traceback (most recent call last):
+            ...
+        ValueError: frame is 799 bytes, expected 800
+    '''
+    def __init__(self, filename, fps = 10, geom = geometry.Default,
+                 buffer_size = 1 << 16):
+        self.fps = fps
+        self.geom = geom
+        self.frame_size = geom.frame_size
+        self.index = []
+        self.file = open(filename, 'wb', buffer_size)
+        self.offset = Header.size
+        self.file.write('\0' * Header.size)   # filled in by close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type = None, exc_value = None, exc_tb = None):
+        self.close()
+        return False
+
+    def write_frame(self, frame):
+        frame = getattr(frame, 'view', frame)
+        if len(frame) != self.frame_size:
+            raise ValueError("frame is %d bytes, expected %d" %
+                               (len(frame), self.frame_size))
+        self.file.write(frame)
+        self.index.append((self.offset, len(frame)))
+        self.offset += len(frame)
+
+    def write_frames(self, frames):
+        for frame in frames:
+            self.write_frame(frame)
+
+    def close(self):
+        if self.file is not None:
+            for entry in self.index:
+                self.file.write(Index_entry.pack(*entry))
+            self.file.seek(0)
+            self.file.write(Header.pack(Magic, Version, self.geom.steps,
+                                        self.geom.radii, self.geom.levels,
+                                        self.frame_size, len(self.index),
+                                        self.fps, self.offset))
+            self.file.close()
+            self.file = None
+
+class reader(object):
+    r'''Random access to the frames in an animation file through mmap.
+
+    reader[i] is frame i as a buffer into the mmap (no copy is made).
+    Iterating over the reader generates the frames in order.  Only the
+    pages actually touched are loaded, so playing even a very long
+    animation runs in constant memory.
+
+    reader.geom is the geometry from the header (with the default
+    first_offset, which isn't recorded).
+
+    Anything that isn't an animation file raises ValueError.
+
+        >>> import os, tempfile
+        >>> filename = os.path.join(tempfile.mkdtemp(), 'test.anim')
+        >>> big = geometry.geometry(1000, 32, 32)
+        >>> with writer(filename, geom = big) as w:
+        ...     w.write_frame('\x03' * big.frame_size)
+        >>> with reader(filename) as r:
+        ...     r.frame_size, r.geom == big
+        (128000, True)
+        >>> size = os.path.getsize(filename)
+        >>> with open(filename, 'r+b') as f: f.truncate(size - 1)
+        >>> reader(filename)     # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        ValueError: ...test.anim: truncated index
+        >>> with open(filename, 'wb') as f: f.write(Magic + 'short')
+        >>> reader(filename)     # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        ValueError: ...test.anim: not an animation file
+    '''
+    def __init__(self, filename):
+        self.map = None
+        self.file = open(filename, 'rb')
+        try:
+            if os.fstat(self.file.fileno()).st_size < Header.size or \
+               self.file.read(len(Magic)) != Magic:
+                raise ValueError("%s: not an animation file" % filename)
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            try:
+                magic, version, self.steps, self.radii, self.levels, \
+                  self.frame_size, self.num_frames, self.fps, \
+                  self.index_offset \
+                    = Header.unpack_from(self.map)
+            except struct.error, e:
+                raise ValueError("%s: bad animation header: %s" %
+                                   (filename, e))
+            if version != Version:
+                raise ValueError("%s: unknown animation file version %d" %
+                                   (filename, version))
+            try:
+                self.geom = geometry.geometry(self.steps, self.radii,
+                                              self.levels)
+            except AssertionError, e:
+                raise ValueError("%s: bad geometry in header: %s" %
+                                   (filename, e))
+            if self.index_offset + self.num_frames * Index_entry.size \
+                 > len(self.map):
+                raise ValueError("%s: truncated index" % filename)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type = None, exc_value = None, exc_tb = None):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, i):
+        if i < 0: i += self.num_frames
+        if not 0 <= i < self.num_frames:
+            raise IndexError("frame %d out of range" % i)
+        offset, length = Index_entry.unpack_from(
+                           self.map, self.index_offset + i * Index_entry.size)
+        return buffer(self.map, offset, length)
+
+    def __iter__(self):
+        return self.frames()
+
+    def frames(self, start = 0):
+        r'''Generates the frames from frame `start` on.
+        '''
+        for i in xrange(start, self.num_frames):
+            yield self[i]
+
+    def close(self):
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -5,14 +5,18 @@
 from __future__ import division
 
 import math
-import itertools
 
+import animation
+import geometry
 import shape
 import render
 
 class ball(shape.sphere):
-    def __init__(self, radius):
+    def __init__(self, radius, geom = geometry.Default):
         super(ball, self).__init__(shape.point(-2, 3, 8), radius)
+        self.geom = geom
+        self.top = geom.levels - 1
+        self.wall = geom.radii - 0.5
         self.v = shape.point(0.3, 0.4, math.sqrt(1.0 - 0.3*0.3 - 0.4*0.4)) \
                       .scale(1.5)
 
@@ -21,12 +25,12 @@ class ball(shape.sphere):
         if self.center.z - self.radius < 0:
             self.center.z += -2*(self.center.z - self.radius)
             self.v.z = -self.v.z
-        elif self.center.z + self.radius > 15:
-            self.center.z -= 2*(self.center.z + self.radius - 15)
+        elif self.center.z + self.radius > self.top:
+            self.center.z -= 2*(self.center.z + self.radius - self.top)
             self.v.z = -self.v.z
         d = math.hypot(self.center.x, self.center.y)
-        if d + self.radius > 7.5:
-            scale = (d - 2*(d + self.radius - 7.5)) / d
+        if d + self.radius > self.wall:
+            scale = (d - 2*(d + self.radius - self.wall)) / d
             self.center.x *= scale
             self.center.y *= scale
             pa = math.atan2(self.center.y, self.center.x)
@@ -36,16 +40,47 @@ class ball(shape.sphere):
             self.v.x = vh * math.cos(va)
             self.v.y = vh * math.sin(va)
 
-    def gen_frame(self):
+    def gen_frame(self, into = None, cache = None):
+        r'''Moves the ball and renders it.
+
+        `cache` is an optional render.frame_cache (for the same geometry).
+        '''
         self.move()
-        return render.frame(self)
-
-def gen(filename = 'bounce.bin', secs = 8, diameter = 4):
-    b = ball(diameter // 2)
-    with open(filename, 'wb') as f:
-        render.to_file(f,
-          itertools.chain.from_iterable(b.gen_frame()
-                                        for _ in xrange(secs * 10)))
+        if cache is None:
+            return render.frame(self, into=into, geom=self.geom)
+        return cache.frame(self, into=into)
+
+    def scenes(self, num_frames):
+        r'''Moves the ball `num_frames` times, generating a scene for each.
+
+        Each scene is a tuple holding a plain sphere at the ball's position
+        at that time, so that it can be rendered in another process.
+        '''
+        for _ in xrange(num_frames):
+            self.move()
+            c = self.center
+            yield (shape.sphere(shape.point(c.x, c.y, c.z), self.radius),)
+
+def gen(filename = 'bounce.anim', secs = 8, diameter = 4, fps = 10,
+        processes = None, geom = geometry.Default):
+    r'''Writes the bouncing ball animation to `filename`.
+
+    The ball's motion is simulated here, while the frames are rendered by
+    `processes` worker processes (see render.frames).
+    '''
+    b = ball(diameter // 2, geom)
+    with animation.writer(filename, fps, geom) as w:
+        w.write_frames(render.frames(b.scenes(secs * fps), processes,
+                                     geom = geom))
+
+def live(geom = geometry.Default, diameter = 4):
+    r'''A scene_fn for driver.live_stream that bounces the ball forever.
+    '''
+    b = ball(diameter // 2, geom)
+    def scene_fn(frame_number):
+        b.move()
+        return (b,)
+    return scene_fn
 
 if __name__ == "__main__":
     gen()
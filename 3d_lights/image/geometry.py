@@ -0,0 +1,265 @@
+# geometry.py
+
+r'''The layout of the lights on a rotating platform.
+
+The platform spins a board of lights: `radii` columns of lights out from the
+center, each `levels` lights high.  Each revolution is split into `steps`
+angular steps.  At each step the board shows one page of the frame, so a
+frame is `steps` pages of `radii` * `levels` lights, one bit per light.
+
+The inner columns sweep out much smaller circles than the outer ones, so they
+only show every few steps (see `multiples`) to keep the lights evenly spread.
+
+The default geometry is the 50 x 8 x 16 platform, with 800 byte frames.
+
+Nothing is computed (or even numpy imported) until the lights are first
+needed.
+'''
+
+from __future__ import division
+
+import os
+import hashlib
+import itertools
+
+# numpy, grid and shape are only imported when the lights are first needed,
+# so that importing this (and render) stays quick.
+
+# The light positions are computed on first use and then saved here, keyed by
+# the geometry parameters, so that later runs can just load them.
+Cache_dir = os.path.join(os.path.expanduser('~'), '.cache', '3d_lights')
+
+# Bump this whenever compute_lights changes, so that the lights cached by
+# the old code aren't used.
+Lights_version = 1
+
+class geometry(object):
+    r'''The dimensions of one platform.
+
+    Lights are numbered by (ro, radius, z): ro is the angular step, radius
+    the column counting in from the outside and z the height.  This is also
+    the order they are stored in a frame (see `index`), so the frame goes
+    page by page (`by_page`) and each page goes column by column.
+
+        >>> g = geometry(100, 16, 32)
+        >>> g.num_lights, g.page_size, g.page_bytes, g.frame_size
+        (51200, 512, 64, 6400)
+        >>> g.index(1, 2, 3), g.where(g.index(1, 2, 3))
+        (579, (1, 2, 3))
+        >>> Default.multiples
+        (1, 1, 1, 1, 2, 3, 5, 35)
+        >>> Default == geometry(), Default == g
+        (True, False)
+    '''
+    def __init__(self, steps = 50, radii = 8, levels = 16,
+                 first_offset = 0.2):
+        assert radii * levels % 8 == 0, \
+               "geometry: a page must be a whole number of bytes"
+        self.steps = steps
+        self.radii = radii
+        self.levels = levels
+        self.first_offset = first_offset        # light closest to center
+        self.last_offset = radii - 1 + first_offset
+        self.multiples = tuple(int(self.last_offset //
+                                     (self.last_offset - radius))
+                               for radius in range(radii))
+        self.page_size = radii * levels         # lights
+        self.page_bytes = self.page_size // 8
+        self.num_lights = steps * self.page_size
+        self.frame_size = self.num_lights // 8  # bytes
+        self.lazy = {}      # filled in by load_lights, grid and lights
+
+    def __repr__(self):
+        return "geometry(%d, %d, %d, %r)" % self.params()
+
+    def params(self):
+        return self.steps, self.radii, self.levels, self.first_offset
+
+    def __eq__(self, b):
+        return isinstance(b, geometry) and self.params() == b.params()
+
+    def __ne__(self, b):
+        return not self == b
+
+    def __hash__(self):
+        return hash(self.params())
+
+    def __getstate__(self):
+        # Don't send the lights through pickle (to worker processes), they
+        # can be loaded from the cache just as fast.
+        return self.params()
+
+    def __setstate__(self, params):
+        self.__init__(*params)
+
+    def index(self, ro, radius, z):
+        r'''The light index of (ro, radius, z).
+        '''
+        return (ro * self.radii + radius) * self.levels + z
+
+    def where(self, i):
+        r'''The (ro, radius, z) of light index i.
+        '''
+        page, i = divmod(i, self.page_size)
+        return (page,) + divmod(i, self.levels)
+
+    def by_page(self, frame):
+        r'''Generates frame by pages.
+
+            >>> g = geometry(3, 2, 8)
+            >>> [''.join(page) for page in g.by_page('abcdefgh' * 6)]
+            ['abcdefghabcdefgh', 'abcdefghabcdefgh', 'abcdefghabcdefgh']
+        '''
+        return grouper(self.page_size, frame)
+
+    def by_row(self, page):
+        r'''Generates page by rows of `radii` lights.
+
+        The rows are generated from the bottom up.
+
+            >>> geometry(3, 2, 8).by_row('abcdefghABCDEFGH')[:3]
+            [('a', 'A'), ('b', 'B'), ('c', 'C')]
+        '''
+        return zip(*grouper(self.levels, page))
+
+    def load_lights(self):
+        r'''Returns (coords, mask) for all of the light positions.
+
+        coords is a (num_lights, 3) numpy array of x, y, z for vectorized
+        rendering.  mask is False for the positions that don't have a light
+        (these have coords of 0, 0, 0).
+
+        These are computed (and checked) on first use, then kept in
+        Cache_dir.  A cached file that can't be read, or doesn't fit this
+        geometry, is computed again and saved over.
+
+            >>> import geometry as module, tempfile, shutil, numpy
+            >>> cache_dir = module.Cache_dir
+            >>> module.Cache_dir = tempfile.mkdtemp()
+            >>> g = geometry(4, 2, 8)
+            >>> filename = os.path.join(module.Cache_dir,
+            ...                         'lights-%s.npz' % g.key())
+            >>> with open(filename, 'wb') as f: f.write('PK junk')
+            >>> g.load_lights()[0].shape
+            (64, 3)
+            >>> save_lights(filename, numpy.zeros((5, 3)), numpy.zeros(5, bool))
+            >>> geometry(4, 2, 8).load_lights()[1].shape
+            (64,)
+            >>> geometry(4, 2, 8).read_lights(filename)[1].shape
+            (64,)
+            >>> shutil.rmtree(module.Cache_dir)
+            >>> module.Cache_dir = cache_dir
+        '''
+        if 'coords' not in self.lazy:
+            filename = os.path.join(Cache_dir, 'lights-%s.npz' % self.key())
+            lights = self.read_lights(filename)
+            if lights is None:
+                lights = self.compute_lights()
+                save_lights(filename, *lights)
+            coords, mask = lights
+            self.lazy['coords'] = coords
+            self.lazy['mask'] = mask
+        return self.lazy['coords'], self.lazy['mask']
+
+    def read_lights(self, filename):
+        r'''Returns the (coords, mask) saved in `filename`, or None if it
+        can't be read or has the wrong shapes for this geometry.
+        '''
+        import numpy
+        try:
+            with open(filename, 'rb') as f:
+                saved = numpy.load(f)
+                coords, mask = saved['coords'], saved['mask']
+        except Exception:   # IOError, BadZipfile, KeyError, ValueError, ...
+            return None
+        if coords.shape != (self.num_lights, 3) or \
+           mask.shape != (self.num_lights,):
+            return None
+        return coords, mask
+
+    def key(self):
+        r'''Names the cached lights for this geometry (and Lights_version).
+        '''
+        params = (Lights_version, self.steps, self.radii, self.levels,
+                  self.first_offset, self.last_offset)
+        return hashlib.sha1(repr(params)).hexdigest()[:16]
+
+    def compute_lights(self):
+        r'''Computes (coords, mask) for load_lights.
+        '''
+        import numpy
+        import shape
+        ro, radius, z = numpy.mgrid[0:self.steps,   # step (=> angle)
+                                    0:self.radii,   # distance from center
+                                    0:self.levels]  # height
+        points = shape.point_array.semi_polar(ro * (360/self.steps),
+                                              self.last_offset - radius, z)
+        mask = (ro % numpy.array(self.multiples)[radius] == 0).ravel()
+        points.coords[~mask] = 0.0
+        self.check_lights(points.coords, mask)
+        return points.coords, mask
+
+    def check_lights(self, coords, mask):
+        r'''Checks that by_page and by_row put the lights where they belong.
+        '''
+        import shape
+        lights = tuple(shape.point(*c) if on else None
+                       for c, on in itertools.izip(coords, mask))
+        assert len(lights) == self.num_lights
+        pages = tuple(self.by_page(lights))
+        assert len(pages) == self.steps
+        for p in pages:
+            for i, row in enumerate(self.by_row(p)):
+                for col in row:
+                    assert col is None or i == col.z
+
+    def light_coords(self):
+        return self.load_lights()[0]
+
+    def light_mask(self):
+        return self.load_lights()[1]
+
+    def grid(self):
+        r'''A grid.grid over the lights so that shapes only test the lights
+        near them.
+        '''
+        if 'grid' not in self.lazy:
+            import grid
+            self.lazy['grid'] = grid.grid(*self.load_lights())
+        return self.lazy['grid']
+
+    def lights(self):
+        r'''A tuple of shape.point for every light position (None if there
+        is no light there).
+        '''
+        if 'lights' not in self.lazy:
+            import shape
+            coords, mask = self.load_lights()
+            self.lazy['lights'] = tuple(shape.point(*c) if on else None
+                                        for c, on in itertools.izip(coords,
+                                                                    mask))
+        return self.lazy['lights']
+
+Default = geometry()
+
+def save_lights(filename, coords, mask):
+    r'''Saves coords and mask in `filename`, if possible.
+    '''
+    import numpy
+    try:
+        if not os.path.isdir(Cache_dir): os.makedirs(Cache_dir)
+        temp = '%s.%d' % (filename, os.getpid())
+        with open(temp, 'wb') as f:
+            numpy.savez(f, coords=coords, mask=mask)
+        os.rename(temp, filename)
+    except (IOError, OSError):
+        pass
+
+def grouper(n, iterable, fillvalue=None):
+    r'''Groups iterable n at a time.
+
+        >>> tuple(grouper(3, 'ABCDEFG', 'x'))
+        (('A', 'B', 'C'), ('D', 'E', 'F'), ('G', 'x', 'x'))
+    '''
+    args = [iter(iterable)] * n
+    return itertools.izip_longest(fillvalue=fillvalue, *args)
@@ -0,0 +1,81 @@
+# grid.py
+
+r'''A spatial index over a fixed set of light coordinates.
+
+The coordinates are bucketed into a Cartesian grid of cubic cells so that a
+shape only has to be tested against the lights in the cells that its bounding
+box overlaps.
+'''
+
+from __future__ import division
+
+import numpy
+
+class grid(object):
+    r'''Cartesian bucket grid over an (n, 3) array of x, y, z coordinates.
+
+    The indices of the coordinates are sorted by cell (x major, z minor) so
+    that each cell, and each run of cells along z, is one slice of
+    self.indices.
+
+        >>> coords = numpy.array([(0.5, 0.5, 0.5), (2.5, 0.5, 0.5),
+        ...                       (0.5, 0.5, 3.5), (9.0, 9.0, 9.0)])
+        >>> g = grid(coords)
+        >>> sorted(g.lookup((0, 0, 0), (1, 1, 1)))
+        [0]
+        >>> sorted(g.lookup((0, 0, 0), (3, 1, 4)))
+        [0, 1, 2]
+        >>> sorted(g.lookup((-5, -5, -5), (20, 20, 20)))
+        [0, 1, 2, 3]
+        >>> sorted(g.lookup((20, 20, 20), (30, 30, 30)))
+        []
+
+    Coordinates where `mask` is False are left out of the grid:
+
+        >>> g = grid(coords, numpy.array((True, False, True, True)))
+        >>> sorted(g.lookup((0, 0, 0), (3, 1, 4)))
+        [0, 2]
+    '''
+    def __init__(self, coords, mask = None, cell_size = 1.0):
+        self.cell_size = cell_size
+        if mask is None:
+            indices = numpy.arange(len(coords))
+        else:
+            indices = numpy.flatnonzero(mask)
+        cells = numpy.floor(coords[indices] / cell_size).astype(int)
+        self.low_cell = cells.min(axis=0)
+        self.shape = tuple(cells.max(axis=0) - self.low_cell + 1)
+        flat = numpy.ravel_multi_index(tuple((cells - self.low_cell).T),
+                                       self.shape)
+        order = numpy.argsort(flat, kind='mergesort')
+        self.indices = indices[order]
+
+        # self.starts[c] is where cell c starts in self.indices, with one
+        # extra entry at the end.
+        counts = numpy.bincount(flat, minlength=numpy.prod(self.shape))
+        self.starts = numpy.concatenate(((0,), numpy.cumsum(counts)))
+
+    def lookup(self, low, high):
+        r'''Returns the indices of the coordinates that may be in the box.
+
+        The box is given by its `low` and `high` corners.  All coordinates
+        inside the box are returned, along with others that share a cell
+        with it.
+        '''
+        cell_low = numpy.floor(numpy.asarray(low) / self.cell_size) \
+                     .astype(int) - self.low_cell
+        cell_high = numpy.floor(numpy.asarray(high) / self.cell_size) \
+                      .astype(int) - self.low_cell
+        cell_low = numpy.maximum(cell_low, 0)
+        cell_high = numpy.minimum(cell_high, numpy.array(self.shape) - 1)
+        if (cell_low > cell_high).any():
+            return self.indices[:0]
+        x_size, y_size, z_size = self.shape
+        pieces = []
+        for x in range(cell_low[0], cell_high[0] + 1):
+            for y in range(cell_low[1], cell_high[1] + 1):
+                first = (x * y_size + y) * z_size
+                pieces.append(
+                  self.indices[self.starts[first + cell_low[2]]:
+                               self.starts[first + cell_high[2] + 1]])
+        return numpy.concatenate(pieces)
@@ -2,30 +2,46 @@
 
 from __future__ import division
 
+import collections
 import itertools
 
-import shape
+import geometry
+
+# numpy, multiprocessing and shape are imported by the functions that use
+# them, so that tools that only need to_binary or grouper import this
+# quickly.
 
 Debug = True
 
-First_offset = 0.2      # offset to light closest to center
+grouper = geometry.grouper
+
+def load_lights(geom = geometry.Default):
+    r'''Returns (coords, mask) for all of the light positions in `geom`.
 
-Last_offset = 7 + First_offset
+    See geometry.load_lights.
+    '''
+    return geom.load_lights()
 
-Multiples = tuple(int(Last_offset // (Last_offset - radius))
-                  for radius in range(8))  # distance from center
+def light_coords(geom = geometry.Default):
+    return geom.light_coords()
 
-print "Multiples", Multiples
+def light_mask(geom = geometry.Default):
+    return geom.light_mask()
 
-Lights = tuple(shape.point.semi_polar(ro * (360/50), Last_offset - radius, z)
-               if ro % Multiples[radius] == 0
-               else None
-               for ro in range(50)    # step (=> angle)
-               for radius in range(8)  # distance from center
-               for z in range(16))    # height
+def light_grid(geom = geometry.Default):
+    return geom.grid()
 
-def by_page(frame):
-    r'''Generates frame by pages of 128.
+def lights(geom = geometry.Default):
+    r'''A tuple of shape.point for every light position (None if there is no
+    light there).
+
+        >>> len(lights()), lights()[0], lights()[8 * 16 + 7 * 16]
+        (6400, (7.2, 0.0, 0.0), None)
+    '''
+    return geom.lights()
+
+def by_page(frame, geom = geometry.Default):
+    r'''Generates frame by pages of 128 (for the default geometry).
 
         >>> pages = tuple(by_page(z for ro in range(50)
         ...                         for radius in range(8)
@@ -35,10 +51,10 @@ def by_page(frame):
         >>> for p in pages[1:]:
         ...     assert p == pages[0]
     '''
-    return grouper(8*16, frame)
+    return geom.by_page(frame)
 
-def by_row(page):
-    r'''Generates page by rows of 8.
+def by_row(page, geom = geometry.Default):
+    r'''Generates page by rows of 8 (for the default geometry).
 
     The rows are generated from the bottom up.
 
@@ -49,30 +65,324 @@ def by_row(page):
         ...         assert col == row[0]
         0 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15
     '''
-    return zip(*grouper(16, page))
+    return geom.by_row(page)
 
 def to_file(f, bytes):
-    for b in bytes:
-        f.write(chr(b))
+    r'''Writes `bytes` to the binary file `f`.
+
+    `bytes` may be a frame_buffer, which is written straight from its buffer,
+    or any iterable of ints.
+    '''
+    if isinstance(bytes, frame_buffer):
+        f.write(bytes.view)
+    else:
+        f.write(bytearray(bytes))
+
+class frame_buffer(object):
+    r'''One image as geom.frame_size bytes (800 by default) in a bytearray.
+
+    Light i (in the order of lights()) is bit i % 8 of byte i // 8.  Lights may
+    be given either by this index or by (ro, radius, z).
+
+        >>> f = frame_buffer()
+        >>> f.set(0, 0, 3)
+        >>> f.set(9)
+        >>> f.test(3), f.test(0, 0, 9), f.test(4)
+        (True, True, False)
+        >>> f.buffer[:3]
+        bytearray(b'\x08\x02\x00')
+        >>> f.clear(3)
+        >>> f.buffer[:3]
+        bytearray(b'\x00\x02\x00')
+
+    The whole buffer can be combined with another frame_buffer:
+
+        >>> g = frame_buffer('\x0f\x0f' + '\x00' * 798)
+        >>> (f | g).buffer[:2], (f & g).buffer[:2], (f ^ g).buffer[:2]
+        (bytearray(b'\x0f\x0f'), bytearray(b'\x00\x02'), bytearray(b'\x0f\r'))
+        >>> f ^= g
+        >>> f.buffer[:2]
+        bytearray(b'\x0f\r')
+
+    Iterating over a frame_buffer generates the bytes as ints.
+
+        >>> list(f)[:3]
+        [15, 13, 0]
+
+    Other geometries have bigger (or smaller) frames:
+
+        >>> big = frame_buffer(geom = geometry.geometry(100, 16, 32))
+        >>> len(big), big.index(1, 2, 3)
+        (6400, 579)
+    '''
+    def __init__(self, data = None, geom = geometry.Default):
+        self.geom = geom
+        self.size = geom.frame_size
+        if data is None:
+            self.buffer = bytearray(self.size)
+        else:
+            self.buffer = bytearray(data)
+            assert len(self.buffer) == self.size, \
+                   "frame_buffer: expected %d bytes, got %d" % \
+                     (self.size, len(self.buffer))
+        self.view = memoryview(self.buffer)
+
+    def __repr__(self):
+        return "<frame_buffer with %d lights on>" % \
+                 sum(bin(b).count('1') for b in self.buffer)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.buffer)
+
+    def __eq__(self, b):
+        return isinstance(b, frame_buffer) and self.buffer == b.buffer
+
+    def __ne__(self, b):
+        return not self == b
+
+    def array(self):
+        r'''A numpy uint8 array that shares the buffer (writes go through).
+        '''
+        import numpy
+        return numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+
+    def copy(self):
+        return frame_buffer(self.buffer, self.geom)
+
+    def index(self, *where):
+        r'''Converts either (i,) or (ro, radius, z) into a light index.
+
+            >>> frame_buffer().index(1, 2, 3)
+            163
+            >>> frame_buffer().index(163)
+            163
+        '''
+        if len(where) == 1: return where[0]
+        return self.geom.index(*where)
+
+    def set(self, *where):
+        i = self.index(*where)
+        self.buffer[i >> 3] |= 1 << (i & 7)
+
+    def clear(self, *where):
+        i = self.index(*where)
+        self.buffer[i >> 3] &= ~(1 << (i & 7)) & 0xff
+
+    def test(self, *where):
+        i = self.index(*where)
+        return bool(self.buffer[i >> 3] & (1 << (i & 7)))
+
+    def __ior__(self, b):
+        a = self.array()
+        a |= b.array()
+        return self
+
+    def __iand__(self, b):
+        a = self.array()
+        a &= b.array()
+        return self
+
+    def __ixor__(self, b):
+        a = self.array()
+        a ^= b.array()
+        return self
 
-def frame(*shapes):
-    return to_binary(any(light in shape for shape in shapes)
-                     for light in Lights)
+    def __or__(self, b):
+        ans = self.copy()
+        ans |= b
+        return ans
 
-def to_binary(bools):
+    def __and__(self, b):
+        ans = self.copy()
+        ans &= b
+        return ans
+
+    def __xor__(self, b):
+        ans = self.copy()
+        ans ^= b
+        return ans
+
+def frame(*shapes, **kws):
+    r'''Renders `shapes` into a frame_buffer for one image.
+
+    The frame_buffer may be passed in as `into` to render in place; otherwise
+    a new one is created.  Either way, it is returned.  The lights are those
+    of the `geom` keyword argument (geometry.Default if not given), which
+    must match the geometry of `into`.  The frame is printed if the `debug`
+    keyword argument is true (Debug if not given).
+
+    Multiple shapes are gathered into a shape.scene.  This tests the
+    light_coords that light_grid finds in its bounds (or all of them if it
+    has no bounds) at once with its contains_array method.  This produces
+    exactly the same bytes as:
+
+        to_binary(any(light in shape for shape in shapes) for light in lights())
+    '''
+    import numpy
+    into = kws.pop('into', None)
+    geom = kws.pop('geom', geometry.Default if into is None else into.geom)
+    debug = kws.pop('debug', Debug)
+    assert not kws, "frame: unknown keyword arguments: %s" % ', '.join(kws)
+    assert into is None or into.geom == geom, "frame: into has wrong geometry"
+    if len(shapes) > 1:
+        import shape
+        shapes = (shape.scene(*shapes),)
+    coords, mask = geom.load_lights()
+    bools = numpy.zeros(len(mask), dtype=bool)
+    for s in shapes:
+        bounds = s.bounds()
+        if bounds is None:
+            bools |= s.contains_array(coords)
+        else:
+            indices = geom.grid().lookup(*bounds)
+            bools[indices[s.contains_array(coords[indices])]] = True
+    bools &= mask
+    if debug:
+        print_frame(bools, geom)
+    if into is None:
+        into = frame_buffer(geom = geom)
+    into.array()[:] = pack_bits(bools)
+    return into
+
+class frame_cache(object):
+    r'''A memoizing layer around `frame`, with an LRU byte budget.
+
+    Frames are keyed by shape.key, so shapes whose parameters snap to the
+    same multiples of `resolution` share one rendering (the first one
+    rendered).  The least recently used frames are dropped once the cached
+    frames take more than `max_bytes`.  All of the frames are rendered for
+    `geom`.
+
+        >>> import render, shape, tempfile, shutil
+        >>> debug, render.Debug = render.Debug, False
+        >>> cache_dir = geometry.Cache_dir
+        >>> geometry.Cache_dir = tempfile.mkdtemp()
+        >>> cache = frame_cache(max_bytes = 1600, geom = geometry.geometry())
+        >>> a = cache.frame(shape.sphere(shape.point(0, 0, 8), 2))
+        >>> b = cache.frame(shape.sphere(shape.point(0.01, 0, 8), 2))
+        >>> c = cache.frame(shape.sphere(shape.point(3, 0, 8), 2))
+        >>> a == b, a == c, cache.hits, cache.misses, len(cache)
+        (True, False, 1, 2, 2)
+        >>> d = cache.frame(shape.sphere(shape.point(0, 3, 8), 2))
+        >>> len(cache), cache.num_bytes
+        (2, 1600)
+        >>> e = cache.frame(shape.sphere(shape.point(0, 0, 8), 2))
+        >>> cache.hits, cache.misses
+        (1, 4)
+        >>> render.Debug = debug
+        >>> shutil.rmtree(geometry.Cache_dir)
+        >>> geometry.Cache_dir = cache_dir
+    '''
+    def __init__(self, max_bytes = 1 << 24, resolution = 0.1,
+                 geom = geometry.Default):
+        self.max_bytes = max_bytes
+        self.resolution = resolution
+        self.geom = geom
+        self.frames = collections.OrderedDict()    # oldest first
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "<frame_cache: %d frames, %d bytes, %d hits, %d misses>" % \
+                 (len(self), self.num_bytes, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def key(self, shapes):
+        return tuple(s.key(self.resolution) for s in shapes)
+
+    def frame(self, *shapes, **kws):
+        r'''Same as `frame`, but only renders shapes not already cached.
+        '''
+        key = self.key(shapes)
+        data = self.frames.pop(key, None)
+        if data is not None:
+            self.hits += 1
+            self.frames[key] = data
+            into = kws.get('into')
+            if into is None: return frame_buffer(data, self.geom)
+            into.buffer[:] = data
+            return into
+        self.misses += 1
+        ans = frame(*shapes, geom = self.geom, **kws)
+        data = str(ans.buffer)
+        self.frames[key] = data
+        self.num_bytes += len(data)
+        while self.num_bytes > self.max_bytes and self.frames:
+            self.num_bytes -= len(self.frames.popitem(last=False)[1])
+        return ans
+
+    __call__ = frame
+
+    def clear(self):
+        self.frames.clear()
+        self.num_bytes = 0
+
+def frames(scenes, processes = None, chunksize = 4, geom = geometry.Default):
+    r'''Renders each scene (a sequence of shapes) into a frame in parallel.
+
+    The scenes are farmed out to a pool of `processes` worker processes (the
+    number of cpus by default).  Generates the frames, in the same order as
+    `scenes`, as strs.  The shapes must be picklable.
+    '''
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        for data in pool.imap(render_scene,
+                              itertools.izip(scenes, itertools.repeat(geom)),
+                              chunksize):
+            yield data
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def render_scene(args):
+    r'''Renders a (shapes, geom) pair into a str.  Run by the frames pool.
+    '''
+    shapes, geom = args
+    return str(frame(*shapes, geom = geom).buffer)
+
+def pack_bits(bools):
+    r'''Packs a numpy array of booleans into bytes (a numpy uint8 array).
+
+    Like line_to_word, the first boolean of each 8 is the LSB.
+
+        >>> import numpy
+        >>> pack_bits(numpy.array((0, 0, 0, 1,  0, 0, 1, 0,
+        ...                        1, 0, 0, 0,  0, 0, 0, 0), dtype=bool)) \
+        ...   .tolist()
+        [72, 1]
+    '''
+    import numpy
+    return numpy.packbits(bools.reshape(-1, 8)[:, ::-1], axis=1).ravel()
+
+def to_binary(bools, geom = geometry.Default):
     r'''Converts 6,400 boolean values into 800 bytes for one image.
+
+    (Or geom.num_lights values into geom.frame_size bytes.)
     '''
     if Debug:
         bools = tuple(bools)
-        assert len(bools) == 6400
-        for page in by_page(bools):
-            for row in tuple(by_row(page))[::-1]:
-                for col in tuple(row)[::-1]:
-                    print 'X ' if col else '. ',
-                print
-            print '*** end page ***'
+        print_frame(bools, geom)
     return (line_to_word(line) for line in grouper(8, bools))
 
+def print_frame(bools, geom = geometry.Default):
+    r'''Prints the 6,400 boolean values for one image, page by page.
+    '''
+    assert len(bools) == geom.num_lights
+    for page in geom.by_page(bools):
+        for row in tuple(geom.by_row(page))[::-1]:
+            for col in tuple(row)[::-1]:
+                print 'X ' if col else '. ',
+            print
+        print '*** end page ***'
+
 def line_to_word(line):
     r'''Converts 8 boolean values into one byte (as an int).
 
@@ -82,21 +392,3 @@ def line_to_word(line):
         '0x48'
     '''
     return int((''.join('1' if b else '0' for b in line[::-1])), 2)
-
-def grouper(n, iterable, fillvalue=None):
-    r'''Groups iterable n at a time.
-
-        >>> tuple(grouper(3, 'ABCDEFG', 'x'))
-        (('A', 'B', 'C'), ('D', 'E', 'F'), ('G', 'x', 'x'))
-    '''
-    args = [iter(iterable)] * n
-    return itertools.izip_longest(fillvalue=fillvalue, *args)
-
-if Debug:
-    assert len(Lights) == 50 * 8 * 16
-    pages = tuple(by_page(Lights))
-    assert len(pages) == 50
-    for p in pages:
-        for i, row in enumerate(by_row(p)):
-            for col in row:
-                assert col is None or i == col.z
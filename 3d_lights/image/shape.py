@@ -4,7 +4,11 @@ from __future__ import division
 
 import math
 
+import numpy
+
 class point(object):
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, x, y, z):
         self.x = x
         self.y = y
@@ -63,19 +67,370 @@ class point(object):
     def scale(self, n):
         return point(self.x * n, self.y * n, self.z * n)
 
+    def __iadd__(self, b):
+        r'''The += operator on points, done in place.
+
+            >>> a = point(1,2,3)
+            >>> b = a
+            >>> a += point(4,5,6)
+            >>> b
+            (5.0, 7.0, 9.0)
+        '''
+        self.x += b.x
+        self.y += b.y
+        self.z += b.z
+        return self
+
+    def __isub__(self, b):
+        r'''The -= operator on points, done in place.
+        '''
+        self.x -= b.x
+        self.y -= b.y
+        self.z -= b.z
+        return self
+
+class point_array(object):
+    r'''Many points stored together in one (n, 3) numpy array of x, y, z.
+
+    The arithmetic is done on all of the points at once.  b may be either a
+    point, which applies to every point, or another point_array of the same
+    length.
+
+        >>> a = point_array([(1, 2, 3), (4, 5, 6)])
+        >>> a + point(1, 1, 1)
+        point_array([(2.0, 3.0, 4.0), (5.0, 6.0, 7.0)])
+        >>> a - a.scale(2)
+        point_array([(-1.0, -2.0, -3.0), (-4.0, -5.0, -6.0)])
+        >>> a.distance_to(point(1, 2, 3)).round(6).tolist()
+        [0.0, 5.196152]
+        >>> a[1], len(a)
+        ((4.0, 5.0, 6.0), 2)
+        >>> a += point(1, 0, 0)
+        >>> a.x.tolist()
+        [2.0, 5.0]
+    '''
+    def __init__(self, coords):
+        if isinstance(coords, point_array):
+            coords = coords.coords
+        self.coords = numpy.array(coords, dtype=float).reshape(-1, 3)
+
+    @classmethod
+    def from_points(cls, points):
+        return cls([(p.x, p.y, p.z) for p in points])
+
+    @classmethod
+    def semi_polar(cls, ro, theta, z):
+        r'''Vectorized point.semi_polar.
+
+        The arguments may be numpy arrays (or numbers), which are broadcast
+        together.  Gives exactly the same coordinates as point.semi_polar.
+
+            >>> point_array.semi_polar(numpy.array([0, 90]), 1, 2)
+            point_array([(1.0, 0.0, 2.0), (0.0, 1.0, 2.0)])
+        '''
+        radians = numpy.radians(ro)
+        x, y, z = numpy.broadcast_arrays(theta * numpy.cos(radians),
+                                         theta * numpy.sin(radians), z)
+        return cls(numpy.column_stack((x.ravel(), y.ravel(), z.ravel())))
+
+    def __repr__(self):
+        return "point_array([%s])" % ', '.join(repr(p) for p in self)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __getitem__(self, i):
+        return point(*self.coords[i])
+
+    def __iter__(self):
+        for c in self.coords:
+            yield point(*c)
+
+    @property
+    def x(self): return self.coords[:, 0]
+
+    @property
+    def y(self): return self.coords[:, 1]
+
+    @property
+    def z(self): return self.coords[:, 2]
+
+    @staticmethod
+    def as_array(b):
+        if isinstance(b, point_array): return b.coords
+        return numpy.array((b.x, b.y, b.z), dtype=float)
+
+    def __add__(self, b):
+        return point_array(self.coords + self.as_array(b))
+
+    def __sub__(self, b):
+        return point_array(self.coords - self.as_array(b))
+
+    def __iadd__(self, b):
+        self.coords += self.as_array(b)
+        return self
+
+    def __isub__(self, b):
+        self.coords -= self.as_array(b)
+        return self
+
+    def scale(self, n):
+        return point_array(self.coords * n)
+
+    def distance_to(self, b):
+        r'''The distances from each point to b, as a numpy array.
+
+        Uses the same nested hypot as point.distance_to.
+        '''
+        d = self.coords - self.as_array(b)
+        return numpy.hypot(numpy.hypot(d[:, 0], d[:, 1]), d[:, 2])
+
+Tolerance = 1e-4        # slop allowed on the surface of shapes
+
+def translation(dx, dy, dz):
+    r'''The 4x4 matrix that moves points by dx, dy, dz.
+    '''
+    ans = numpy.identity(4)
+    ans[:3, 3] = dx, dy, dz
+    return ans
+
+def rotation(degrees, axis = 'z'):
+    r'''The 4x4 matrix that rotates points counterclockwise about `axis`.
+
+        >>> numpy.round(rotation(90).dot((1, 0, 0, 1)), 6).tolist()
+        [0.0, 1.0, 0.0, 1.0]
+    '''
+    radians = math.radians(degrees)
+    c, s = math.cos(radians), math.sin(radians)
+    i, j = {'x': (1, 2), 'y': (2, 0), 'z': (0, 1)}[axis]
+    ans = numpy.identity(4)
+    ans[i, i] = ans[j, j] = c
+    ans[i, j] = -s
+    ans[j, i] = s
+    return ans
+
+def scaling(sx, sy, sz):
+    r'''The 4x4 matrix that scales points by sx, sy, sz.
+    '''
+    return numpy.diag((sx, sy, sz, 1.0))
+
 class shape(object):
-    r'''Might add coordinate transformation logic here later...
+    r'''Base class for all shapes.
+
+    Shapes are defined in their own (local) coordinates.  They may then be
+    moved with translate, rotate and scale.  Each of these returns the shape,
+    so they can be chained.  The combined transformation is kept as a 4x4
+    matrix (`transform`, local to world) along with its inverse (`inverse`,
+    world to local), which contains_array applies once to the whole array
+    of light coordinates.
+
+    Subclasses must define `local_contains_array` (vectorized), or else
+    `contains` (one point), which the default local_contains_array then
+    calls for each point.  They define `local_bounds` if they are bounded,
+    and `params` so that frame_cache can cache them.
+
+    Shapes may be combined with | (union), & (intersection) and
+    - (difference).  The whole tree is then evaluated one array of lights
+    at a time.
+
+    Shapes that define `local_distance_array` (a signed distance field:
+    negative inside, positive outside) can also be rendered as a hollow
+    `shell` or an iso-surface `band`.
+
+    Leaving out the methods that are used fails with NotImplementedError:
+
+        >>> class blob(shape): pass
+        >>> point(0, 0, 0) in blob()
+        Traceback (most recent call last):
+            ...
+        NotImplementedError: blob must define local_contains_array or contains
+        >>> class dot(shape):
+        ...     def contains(self, p): return p.x == p.y == p.z == 0
+        >>> point(0, 0, 0) in dot(), point(0, 0, 0) in dot().translate(1, 0, 0)
+        (True, False)
+        >>> dot().key(0.1)
+        Traceback (most recent call last):
+            ...
+        NotImplementedError: dot must define params to have a key
     '''
+    transform = None    # local to world, None means no transformation
+    inverse = None      # world to local
+    distance_scale = 1.0    # local to world distances
+
     def __init__(self): pass
 
     def __contains__(self, point):
         if point is None: return False
-        return self.contains(point)
+        if self.inverse is None: return self.contains(point)
+        return bool(self.contains_array(
+                      numpy.array(((point.x, point.y, point.z),)))[0])
+
+    def contains(self, point):
+        r'''Tests one point in local coordinates.
+
+        This default calls local_contains_array.
+        '''
+        return bool(self.local_contains_array(
+                      numpy.array(((point.x, point.y, point.z),)))[0])
+
+    def contains_array(self, coords):
+        r'''Tests a whole (n, 3) array of x, y, z coordinates at once.
+
+        Returns an array of n bools.
+        '''
+        return self.local_contains_array(self.to_local(coords))
+
+    def local_contains_array(self, coords):
+        r'''Tests an (n, 3) array of coordinates in local coordinates.
+
+        This is the primitive that subclasses should define (vectorized).
+        This default just calls the subclass's `contains` on each point, and
+        fails if it doesn't define that either.
+        '''
+        if type(self).contains.im_func is shape.contains.im_func:
+            raise NotImplementedError(
+                    "%s must define local_contains_array or contains" %
+                      type(self).__name__)
+        return numpy.fromiter((self.contains(point(*c)) for c in coords),
+                              dtype=bool, count=len(coords))
+
+    def distance_array(self, coords):
+        r'''Signed distances from an (n, 3) array of coordinates to the surface.
+
+        Negative inside the shape, positive outside.  Returns an array of n
+        floats.  If the shape has been scaled differently along different
+        axes, this underestimates the true distance.
+        '''
+        return self.local_distance_array(self.to_local(coords)) \
+                 * self.distance_scale
+
+    def local_distance_array(self, coords):
+        r'''Signed distances in local coordinates, see `distance_array`.
+
+        Subclasses that can be used in a shell or band must define this;
+        there's no default.
+        '''
+        raise NotImplementedError(
+                "%s must define local_distance_array to be used in a shell "
+                "or band" % type(self).__name__)
+
+    def to_local(self, coords):
+        r'''Converts an (n, 3) array of world coordinates to local coordinates.
+        '''
+        if self.inverse is None: return coords
+        return coords.dot(self.inverse[:3, :3].T) + self.inverse[:3, 3]
+
+    def bounds(self):
+        r'''Returns the (low, high) corners of a box holding the shape.
+
+        Each corner is an x, y, z tuple.  None means that the shape is not
+        bounded, so all lights must be tested.
+
+            >>> low, high = box(point(0, 0, 0), point(2, 1, 1)) \
+            ...               .rotate(90).translate(10, 0, 0).bounds()
+            >>> numpy.round(low, 3).tolist(), numpy.round(high, 3).tolist()
+            ([9.0, -0.0, -0.0], [10.0, 2.0, 1.0])
+        '''
+        bounds = self.local_bounds()
+        if bounds is None or self.transform is None: return bounds
+        (x0, y0, z0), (x1, y1, z1) = bounds
+        corners = numpy.array([(x, y, z, 1.0) for x in (x0, x1)
+                                              for y in (y0, y1)
+                                              for z in (z0, z1)])
+        corners = corners.dot(self.transform.T)[:, :3]
+        return tuple(corners.min(axis=0)), tuple(corners.max(axis=0))
+
+    def local_bounds(self):
+        r'''Bounds in local coordinates, see `bounds`.
+        '''
+        return None
+
+    def transformed(self, matrix):
+        r'''Applies the 4x4 `matrix` after any earlier transformations.
+
+        Returns self.
+        '''
+        if self.transform is None:
+            self.transform = matrix
+        else:
+            self.transform = matrix.dot(self.transform)
+        self.inverse = numpy.linalg.inv(self.transform)
+        self.distance_scale = \
+          numpy.linalg.svd(self.transform[:3, :3], compute_uv=False).min()
+        return self
+
+    def translate(self, dx, dy, dz):
+        return self.transformed(translation(dx, dy, dz))
+
+    def rotate(self, degrees, axis = 'z'):
+        return self.transformed(rotation(degrees, axis))
+
+    def scale(self, sx, sy = None, sz = None):
+        if sy is None: sy = sx
+        if sz is None: sz = sx
+        return self.transformed(scaling(sx, sy, sz))
+
+    def params(self):
+        r'''The values that determine what the shape looks like.
+
+        Used by `key`.  Values may be numbers, points, numpy arrays, shapes
+        or tuples of these.  Every subclass must define this; there's no
+        default.
+        '''
+        raise NotImplementedError("%s must define params to have a key" %
+                                    type(self).__name__)
+
+    def key(self, resolution):
+        r'''A hashable key for what this shape renders to.
+
+        All of the numbers in `params` (and the transform) are snapped to
+        multiples of `resolution`, so shapes that only differ by less than
+        that (usually) have the same key.
+
+            >>> sphere(point(1, 2, 3), 2).key(0.1) == \
+            ...   sphere(point(1.01, 2, 3), 2).key(0.1)
+            True
+            >>> sphere(point(1, 2, 3), 2).key(0.1) == \
+            ...   sphere(point(1.2, 2, 3), 2).key(0.1)
+            False
+            >>> sphere(point(1, 2, 3), 2).key(0.1) == \
+            ...   sphere(point(1, 2, 3), 2).translate(1, 0, 0).key(0.1)
+            False
+        '''
+        return (type(self).__name__, quantize(self.params(), resolution),
+                None if self.transform is None
+                     else quantize(self.transform, resolution))
+
+    def __or__(self, b):
+        return union(self, b)
+
+    def __and__(self, b):
+        return intersection(self, b)
+
+    def __sub__(self, b):
+        return difference(self, b)
+
+def quantize(value, resolution):
+    r'''Snaps all of the numbers in `value` to multiples of `resolution`.
+
+    Returns a hashable value (tuples of ints).
+
+        >>> quantize((1.04, point(0.96, -1.0, 2.0), numpy.array([0.5, 1.5])),
+        ...          0.1)
+        (10, (10, -10, 20), (5, 15))
+    '''
+    if isinstance(value, shape):
+        return value.key(resolution)
+    if isinstance(value, point):
+        value = (value.x, value.y, value.z)
+    if isinstance(value, numpy.ndarray):
+        return tuple(numpy.round(value.ravel() / resolution).astype(int))
+    if isinstance(value, (tuple, list)):
+        return tuple(quantize(v, resolution) for v in value)
+    return int(round(value / resolution))
 
 class sphere(shape):
     r'''A simple sphere.
-    
-    Don't have to worry about coordinate transformations here!
 
         >>> point(1,0,0) in sphere(point(0,0,0), 1)
         True
@@ -85,6 +440,11 @@ class sphere(shape):
         True
         >>> point(0.57736,0.57736,0.57736) in sphere(point(0,0,0), 1)
         False
+
+    Scaling it makes an ellipsoid:
+
+        >>> point(0, 1.5, 0) in sphere(point(0,0,0), 1).scale(1, 2, 1)
+        True
     '''
     def __init__(self, center, radius):
         self.center = center
@@ -93,5 +453,489 @@ class sphere(shape):
     def __repr__(self):
         return "<sphere at %s, radius %g>" % (self.center, self.radius)
 
+    def params(self):
+        return self.center, self.radius
+
+    def contains(self, point):
+        return self.center.distance_to(point) <= self.radius + Tolerance
+
+    def local_contains_array(self, coords):
+        r'''Vectorized `contains`.
+
+        Uses the same nested hypot as `point.distance_to` so that the answers
+        are identical to `contains`.
+
+            >>> sphere(point(0,0,0), 1).contains_array(
+            ...   numpy.array([(1,0,0), (1,0.1,0), (0.5,0.5,0.5)])).tolist()
+            [True, False, True]
+        '''
+        c = self.center
+        return numpy.hypot(numpy.hypot(coords[:, 0] - c.x, coords[:, 1] - c.y),
+                           coords[:, 2] - c.z) \
+                 <= self.radius + Tolerance
+
+    def local_distance_array(self, coords):
+        r'''
+            >>> sphere(point(0,0,0), 2).distance_array(
+            ...   numpy.array([(0,0,0), (3,0,0)])).tolist()
+            [-2.0, 1.0]
+            >>> sphere(point(0,0,0), 2).scale(2).distance_array(
+            ...   numpy.array([(0,0,0), (5,0,0)])).tolist()
+            [-4.0, 1.0]
+        '''
+        c = self.center
+        return numpy.hypot(numpy.hypot(coords[:, 0] - c.x, coords[:, 1] - c.y),
+                           coords[:, 2] - c.z) \
+                 - self.radius
+
+    def local_bounds(self):
+        r'''
+            >>> low, high = sphere(point(1,2,3), 2).bounds()
+            >>> point(*low), point(*high)
+            ((-1.0, 0.0, 1.0), (3.0, 4.0, 5.0))
+        '''
+        c = self.center
+        r = self.radius + Tolerance
+        return (c.x - r, c.y - r, c.z - r), (c.x + r, c.y + r, c.z + r)
+
+class box(shape):
+    r'''A box with sides parallel to the axes, given by two opposite corners.
+
+        >>> b = box(point(0, 0, 0), point(2, 1, 1))
+        >>> point(2, 0.5, 1) in b, point(2.1, 0.5, 1) in b
+        (True, False)
+        >>> point(-0.5, 1.5, 0) in b.rotate(90)
+        True
+        >>> point(0.5, 0.5, 0) in b
+        False
+    '''
+    def __init__(self, low, high):
+        self.low = numpy.array((low.x, low.y, low.z), dtype=float)
+        self.high = numpy.array((high.x, high.y, high.z), dtype=float)
+
+    def __repr__(self):
+        return "<box from %s to %s>" % (point(*self.low), point(*self.high))
+
+    def params(self):
+        return self.low, self.high
+
+    def local_contains_array(self, coords):
+        return ((coords >= self.low - Tolerance) &
+                (coords <= self.high + Tolerance)).all(axis=1)
+
+    def local_distance_array(self, coords):
+        r'''
+            >>> box(point(0, 0, 0), point(2, 2, 2)).distance_array(
+            ...   numpy.array([(1, 1, 1), (1, 1, 3), (4, 5, 1)])).tolist()
+            [-1.0, 1.0, 3.605551275463989]
+        '''
+        return box_distance(numpy.abs(coords - (self.low + self.high) / 2)
+                              - (self.high - self.low) / 2)
+
+    def local_bounds(self):
+        return tuple(self.low - Tolerance), tuple(self.high + Tolerance)
+
+class cylinder(shape):
+    r'''An upright cylinder, standing on the center of its base.
+
+        >>> c = cylinder(point(0, 0, 2), 1, 3)
+        >>> point(1, 0, 2) in c, point(0, 0, 5) in c, point(0, 0, 5.1) in c
+        (True, True, False)
+        >>> point(0, 0, 1.9) in c, point(0.8, 0.8, 3) in c
+        (False, False)
+    '''
+    def __init__(self, base, radius, height):
+        self.base = base
+        self.radius = radius
+        self.height = height
+
+    def __repr__(self):
+        return "<cylinder on %s, radius %g, height %g>" % \
+                 (self.base, self.radius, self.height)
+
+    def params(self):
+        return self.base, self.radius, self.height
+
+    def local_contains_array(self, coords):
+        b = self.base
+        z = coords[:, 2] - b.z
+        return (numpy.hypot(coords[:, 0] - b.x, coords[:, 1] - b.y)
+                  <= self.radius + Tolerance) \
+             & (z >= -Tolerance) & (z <= self.height + Tolerance)
+
+    def local_distance_array(self, coords):
+        r'''
+            >>> cylinder(point(0, 0, 2), 1, 3).distance_array(
+            ...   numpy.array([(0, 0, 3.5), (0, 0, 6), (3, 0, 3)])).tolist()
+            [-1.0, 1.0, 2.0]
+        '''
+        b = self.base
+        half = self.height / 2
+        return box_distance(numpy.column_stack((
+                 numpy.hypot(coords[:, 0] - b.x, coords[:, 1] - b.y)
+                   - self.radius,
+                 numpy.abs(coords[:, 2] - b.z - half) - half)))
+
+    def local_bounds(self):
+        b = self.base
+        r = self.radius + Tolerance
+        return (b.x - r, b.y - r, b.z - Tolerance), \
+               (b.x + r, b.y + r, b.z + self.height + Tolerance)
+
+class plane(shape):
+    r'''Everything on one side of a plane (a half-space).
+
+    The plane goes through `origin`, and `normal` points away from the
+    inside.  This is not bounded, but is handy in intersections and
+    differences.
+
+        >>> p = plane(point(0, 0, 8), point(0, 0, 1))
+        >>> point(5, 5, 8) in p, point(5, 5, 7) in p, point(0, 0, 8.1) in p
+        (True, True, False)
+    '''
+    def __init__(self, origin, normal):
+        self.origin = numpy.array((origin.x, origin.y, origin.z), dtype=float)
+        self.normal = numpy.array((normal.x, normal.y, normal.z), dtype=float)
+        self.normal /= numpy.linalg.norm(self.normal)
+
+    def __repr__(self):
+        return "<plane through %s, normal %s>" % \
+                 (point(*self.origin), point(*self.normal))
+
+    def params(self):
+        return self.origin, self.normal
+
+    def local_contains_array(self, coords):
+        return (coords - self.origin).dot(self.normal) <= Tolerance
+
+    def local_distance_array(self, coords):
+        return (coords - self.origin).dot(self.normal)
+
+class torus(shape):
+    r'''A torus lying flat (around the z axis through its center).
+
+    `major` is the radius from the center to the middle of the tube, and
+    `minor` is the radius of the tube.
+
+        >>> t = torus(point(0, 0, 8), 5, 1)
+        >>> point(5, 0, 8) in t, point(0, 6, 8) in t, point(0, 0, 8) in t
+        (True, True, False)
+        >>> point(-5, 0, 9) in t, point(-5, 0, 9.1) in t
+        (True, False)
+    '''
+    def __init__(self, center, major, minor):
+        self.center = center
+        self.major = major
+        self.minor = minor
+
+    def __repr__(self):
+        return "<torus at %s, radii %g, %g>" % \
+                 (self.center, self.major, self.minor)
+
+    def params(self):
+        return self.center, self.major, self.minor
+
+    def local_contains_array(self, coords):
+        c = self.center
+        return numpy.hypot(numpy.hypot(coords[:, 0] - c.x, coords[:, 1] - c.y)
+                             - self.major,
+                           coords[:, 2] - c.z) \
+                 <= self.minor + Tolerance
+
+    def local_distance_array(self, coords):
+        c = self.center
+        return numpy.hypot(numpy.hypot(coords[:, 0] - c.x, coords[:, 1] - c.y)
+                             - self.major,
+                           coords[:, 2] - c.z) \
+                 - self.minor
+
+    def local_bounds(self):
+        c = self.center
+        r = self.major + self.minor + Tolerance
+        h = self.minor + Tolerance
+        return (c.x - r, c.y - r, c.z - h), (c.x + r, c.y + r, c.z + h)
+
+class union(shape):
+    r'''Everything in any of the shapes.
+
+    Each shape only tests the lights not already in an earlier shape.
+
+        >>> u = sphere(point(0, 0, 0), 1) | sphere(point(3, 0, 0), 1)
+        >>> u.contains_array(numpy.array([(0, 0, 0), (1.5, 0, 0),
+        ...                               (3, 0, 1)])).tolist()
+        [True, False, True]
+        >>> u.bounds() == ((-1.0001, -1.0001, -1.0001), (4.0001, 1.0001, 1.0001))
+        True
+    '''
+    def __init__(self, *shapes):
+        self.shapes = shapes
+
+    def __repr__(self):
+        return "<union of %s>" % ', '.join(repr(s) for s in self.shapes)
+
+    def params(self):
+        return self.shapes
+
+    def local_contains_array(self, coords):
+        ans = numpy.zeros(len(coords), dtype=bool)
+        for s in self.shapes:
+            indices = numpy.flatnonzero(~ans)
+            ans[indices] = s.contains_array(coords[indices])
+        return ans
+
+    def local_distance_array(self, coords):
+        return numpy.min([s.distance_array(coords) for s in self.shapes],
+                         axis=0)
+
+    def local_bounds(self):
+        bounds = [s.bounds() for s in self.shapes]
+        if not bounds or None in bounds: return None
+        return tuple(numpy.min([low for low, high in bounds], axis=0)), \
+               tuple(numpy.max([high for low, high in bounds], axis=0))
+
+class intersection(shape):
+    r'''Only what is in all of the shapes.
+
+    Each shape only tests the lights that are in all of the earlier shapes.
+
+        >>> i = sphere(point(0, 0, 0), 2) & box(point(0, 0, 0), point(3, 3, 3))
+        >>> i.contains_array(numpy.array([(1, 1, 1), (-1, 0, 0),
+        ...                               (2, 2, 0)])).tolist()
+        [True, False, False]
+        >>> i.bounds() == ((-0.0001, -0.0001, -0.0001), (2.0001, 2.0001, 2.0001))
+        True
+    '''
+    def __init__(self, *shapes):
+        self.shapes = shapes
+
+    def __repr__(self):
+        return "<intersection of %s>" % ', '.join(repr(s) for s in self.shapes)
+
+    def params(self):
+        return self.shapes
+
+    def local_contains_array(self, coords):
+        ans = numpy.ones(len(coords), dtype=bool)
+        for s in self.shapes:
+            indices = numpy.flatnonzero(ans)
+            ans[indices] = s.contains_array(coords[indices])
+        return ans
+
+    def local_distance_array(self, coords):
+        return numpy.max([s.distance_array(coords) for s in self.shapes],
+                         axis=0)
+
+    def local_bounds(self):
+        bounds = [b for b in (s.bounds() for s in self.shapes) if b is not None]
+        if not bounds: return None
+        return tuple(numpy.max([low for low, high in bounds], axis=0)), \
+               tuple(numpy.min([high for low, high in bounds], axis=0))
+
+class difference(shape):
+    r'''What is in shape `a`, but not in shape `b`.
+
+    Shape `b` only tests the lights that are in shape `a`.
+
+        >>> d = sphere(point(0, 0, 0), 2) - plane(point(0, 0, 0), point(0, 0, 1))
+        >>> d.contains_array(numpy.array([(0, 0, 1), (0, 0, -1)])).tolist()
+        [True, False]
+        >>> d.bounds() == sphere(point(0, 0, 0), 2).bounds()
+        True
+    '''
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def __repr__(self):
+        return "<%r minus %r>" % (self.a, self.b)
+
+    def params(self):
+        return self.a, self.b
+
+    def local_contains_array(self, coords):
+        ans = self.a.contains_array(coords)
+        indices = numpy.flatnonzero(ans)
+        ans[indices] = ~self.b.contains_array(coords[indices])
+        return ans
+
+    def local_distance_array(self, coords):
+        return numpy.maximum(self.a.distance_array(coords),
+                             -self.b.distance_array(coords))
+
+    def local_bounds(self):
+        return self.a.bounds()
+
+def box_distance(q):
+    r'''Signed distance to a box, given the (n, d) distances `q` outside of
+    each of its d pairs of sides (negative inside).
+
+        >>> box_distance(numpy.array([(-1.0, -2.0), (3.0, 4.0), (-1.0, 2.0)])) \
+        ...   .tolist()
+        [-1.0, 5.0, 2.0]
+    '''
+    return numpy.sqrt((numpy.maximum(q, 0.0) ** 2).sum(axis=1)) \
+             + numpy.minimum(q.max(axis=1), 0.0)
+
+class shell(shape):
+    r'''Renders only the outer `thickness` of a shape (a hollow shape).
+
+    `shape` must have a distance function.
+
+        >>> s = shell(sphere(point(0, 0, 0), 3), 1)
+        >>> s.contains_array(numpy.array([(0, 0, 1), (0, 2.5, 0), (0, 0, 3),
+        ...                               (3.1, 0, 0)])).tolist()
+        [False, True, True, False]
+    '''
+    def __init__(self, shape, thickness = 1.0):
+        self.shape = shape
+        self.thickness = thickness
+
+    def __repr__(self):
+        return "<shell %g thick of %r>" % (self.thickness, self.shape)
+
+    def params(self):
+        return self.shape, self.thickness
+
+    def local_contains_array(self, coords):
+        d = self.shape.distance_array(coords)
+        return (d >= -self.thickness - Tolerance) & (d <= Tolerance)
+
+    def local_distance_array(self, coords):
+        return numpy.abs(self.shape.distance_array(coords)
+                           + self.thickness / 2) \
+                 - self.thickness / 2
+
+    def local_bounds(self):
+        return self.shape.bounds()
+
+class band(shape):
+    r'''Renders the lights within `width`/2 of an iso-surface of a shape.
+
+    The iso-surface is where the shape's signed distance is `level` (0 is
+    the shape's own surface).  `shape` must have a distance function.
+
+        >>> b = band(sphere(point(0, 0, 0), 3), 1, level = 1)
+        >>> b.contains_array(numpy.array([(0, 0, 3), (0, 3.5, 0), (4.5, 0, 0),
+        ...                               (0, 0, 4.6)])).tolist()
+        [False, True, True, False]
+    '''
+    def __init__(self, shape, width = 1.0, level = 0.0):
+        self.shape = shape
+        self.width = width
+        self.level = level
+
+    def __repr__(self):
+        return "<band %g wide at %g of %r>" % \
+                 (self.width, self.level, self.shape)
+
+    def params(self):
+        return self.shape, self.width, self.level
+
+    def local_contains_array(self, coords):
+        return numpy.abs(self.shape.distance_array(coords) - self.level) \
+                 <= self.width / 2 + Tolerance
+
+    def local_distance_array(self, coords):
+        return numpy.abs(self.shape.distance_array(coords) - self.level) \
+                 - self.width / 2
+
+    def local_bounds(self):
+        bounds = self.shape.bounds()
+        if bounds is None: return None
+        grow = max(self.level + self.width / 2, 0.0) + Tolerance
+        return tuple(numpy.array(bounds[0]) - grow), \
+               tuple(numpy.array(bounds[1]) + grow)
+
+class scene(shape):
+    r'''A collection of shapes that acts as their union.
+
+    A bounding volume hierarchy is built over the bounds of the shapes when
+    the scene is created, so contains_array only tests each light against the
+    shapes whose bounds hold that light.  Build a new scene for each frame if
+    the shapes move.
+
+        >>> s = scene(*(sphere(point(x, 0, 0), 1) for x in range(0, 100, 4)))
+        >>> point(40, 0, 0.5) in s
+        True
+        >>> point(42, 0, 0) in s
+        False
+        >>> s.contains_array(numpy.array([(40, 0, 0.5), (42, 0, 0),
+        ...                               (96, 1, 0), (97, 1, 0)])).tolist()
+        [True, False, True, False]
+        >>> s.bounds() == ((-1.0001, -1.0001, -1.0001), (97.0001, 1.0001, 1.0001))
+        True
+    '''
+    def __init__(self, *shapes):
+        self.shapes = shapes
+        self.unbounded = []
+        bounded = []
+        for s in shapes:
+            bounds = s.bounds()
+            if bounds is None:
+                self.unbounded.append(s)
+            else:
+                bounded.append((s, numpy.array(bounds[0], dtype=float),
+                                   numpy.array(bounds[1], dtype=float)))
+        self.root = bvh_node(bounded) if bounded else None
+
+    def __repr__(self):
+        return "<scene of %d shapes>" % len(self.shapes)
+
+    def params(self):
+        return self.shapes
+
     def contains(self, point):
-        return self.center.distance_to(point) <= self.radius + 1e-4
+        return any(point in s for s in self.shapes)
+
+    def local_contains_array(self, coords):
+        ans = numpy.zeros(len(coords), dtype=bool)
+        for s in self.unbounded:
+            ans |= s.contains_array(coords)
+        if self.root is not None:
+            self.root.mark(coords, numpy.flatnonzero(~ans), ans)
+        return ans
+
+    def local_distance_array(self, coords):
+        return numpy.min([s.distance_array(coords) for s in self.shapes],
+                         axis=0)
+
+    def local_bounds(self):
+        if self.unbounded or self.root is None: return None
+        return tuple(self.root.low), tuple(self.root.high)
+
+class bvh_node(object):
+    r'''One node of the bounding volume hierarchy used by scene.
+
+    `shapes` is a list of (shape, low, high) for the shapes under this node.
+    Each leaf holds one shape and has that shape's bounds.  Otherwise the
+    shapes are split at the median of their centers along the longest side
+    of the node's box.
+    '''
+    def __init__(self, shapes):
+        self.low = numpy.min([low for s, low, high in shapes], axis=0)
+        self.high = numpy.max([high for s, low, high in shapes], axis=0)
+        if len(shapes) == 1:
+            self.shape = shapes[0][0]
+            self.children = ()
+        else:
+            self.shape = None
+            axis = numpy.argmax(self.high - self.low)
+            shapes = sorted(shapes,
+                            key=lambda (s, low, high): low[axis] + high[axis])
+            half = len(shapes) // 2
+            self.children = (bvh_node(shapes[:half]), bvh_node(shapes[half:]))
+
+    def mark(self, coords, indices, ans):
+        r'''Sets ans[i] to True for the indices whose coords are in a shape.
+
+        Only the `indices` in this node's box are passed down to the children.
+        '''
+        c = coords[indices]
+        indices = indices[((c >= self.low) & (c <= self.high)).all(axis=1)]
+        if len(indices):
+            if self.shape is not None:
+                indices = indices[~ans[indices]]
+                ans[indices[self.shape.contains_array(coords[indices])]] = True
+            else:
+                for child in self.children:
+                    child.mark(coords, indices, ans)
@@ -0,0 +1,33 @@
+// messages.h
+
+// Generated from the stationary_platform message_schema, don't edit!
+//
+// Each message is its id byte, then the fields MSB first.
+
+#ifndef MESSAGES_H
+#define MESSAGES_H
+
+// stationary_platform: %x, %x\n
+//   byte test (u1)
+//   int test (u2)
+#define WELCOME_MSG              1
+#define WELCOME_MSG_SIZE         3
+
+// Incomplete_bufs=%d@%d, FE=%d@%d, DOR=%d@%d, Buf_overflows=%d@%d\n
+//   Incomplete_bufs (u1)
+//   Where_incomplete (u1)
+//   Framing_errors (u1)
+//   Where_framing_error (u1)
+//   Data_overrun_errors (u1)
+//   Where_data_overrun (u1)
+//   Buf_overflows (u2)
+//   Where_overflow (u1)
+#define ERROR_COUNT_MSG          2
+#define ERROR_COUNT_MSG_SIZE     9
+
+// RPS=%.1f, mSec/rev=%.1f\n
+//   TCNT1 (u2)
+#define RPS_MSG                  3
+#define RPS_MSG_SIZE             2
+
+#endif /* MESSAGES_H */
@@ -30,15 +30,9 @@
 #define SYNC_CHAR   0xD8
 #define ESC_CHAR    0x27
 
-#define WELCOME_MSG         1   /* byte test, int test */
-
-// Incomplete_bufs (u1), Where_incomplete (u1),
-// Framing_errors (u1), Where_framing_error (u1),
-// Data_overrun_errors (u1), Where_data_overrun (u1),
-// Buf_overflows (u2), Where_overflow (u1)
-#define ERROR_COUNT_MSG     2
-
-#define RPS_MSG             3   /* TCNT1 */
+// WELCOME_MSG, ERROR_COUNT_MSG and RPS_MSG, generated by
+// "python driver.py --c-header" in 3d_lights/PC.
+#include "messages.h"
 
 void
 print_char(char c) {
@@ -5,12 +5,18 @@
 from __future__ import with_statement, print_function
 
 import os
+import re
+import time
+import errno
+import select
+import struct
 import signal
 import sys
 import thread
 import threading
 import traceback
 import optparse
+import Queue
 
 from pyterm import comm
 
@@ -30,6 +36,7 @@ class terminal(object):
     These can be used as context managers.
     '''
     thread = None
+    loop = None         # the event_loop running this terminal, if any
 
     def __init__(self, consumer = None):
         self.destinations = []
@@ -90,19 +97,10 @@ class terminal(object):
             self.thread_init()
             while self.destinations and not self.closed:
                 #sys.stderr.write("%s: top of loop\n" % (self.name,))
-                read_len = self.destinations[0].read_len
-                if read_len is None:
-                    data = self.read()
-                    #sys.stderr.write("%s: read %r\n" % (self.name, data))
-                else:
-                    data = self.read(read_len)
-                if not self.destinations or (not data and self.close_on_eof):
+                if not self.step():
                     #sys.stderr.write("%s: 0 dests or eof, %d destinations\n" %
                     #                   (self.name, len(self.destinations)))
                     break
-                #sys.stderr.write("%s: doing write\n" % (self.name,))
-                self.destinations[0].write(data)
-                #sys.stderr.write("%s: did write\n" % (self.name,))
         except Exception, e:
             #sys.stderr.write("%s: run caught %r\n" % (self.name, e))
             traceback.print_exc()
@@ -117,6 +115,42 @@ class terminal(object):
             #    self.thread.exit()
             #    sys.stderr.write("You should not see this!\n")
 
+    def step(self):
+        r'''Reads once and passes what was read to the first destination.
+
+        Returns False if there's nowhere left to pass it, or on EOF if
+        close_on_eof.
+        '''
+        if not self.destinations: return False
+        read_len = self.destinations[0].read_len
+        if read_len is None:
+            data = self.read()
+            #sys.stderr.write("%s: read %r\n" % (self.name, data))
+        else:
+            data = self.read(read_len)
+        if not self.destinations or (not data and self.close_on_eof):
+            return False
+        #sys.stderr.write("%s: doing write\n" % (self.name,))
+        self.destinations[0].write(data)
+        #sys.stderr.write("%s: did write\n" % (self.name,))
+        return True
+
+    def on_readable(self):
+        r'''Called by the event_loop when fileno() is ready to read.
+
+        Must not block, and returns False when the terminal is done.
+        '''
+        return self.step()
+
+    def wait_until(self):
+        r'''Tells the event_loop when to call on_readable next.
+
+        None (this default) means whenever fileno() is ready to read.
+        Otherwise it's a time.time() for the loop to wait for instead of
+        watching fileno().
+        '''
+        return None
+
 class usb(terminal):
     r'''Reads and writes to USB (Arduino).
 
@@ -125,9 +159,19 @@ class usb(terminal):
 
     `format_strings` is a dict mapping the initial byte value to the
     :class:`.format_string` object.
+
+    Each read takes whatever has arrived (up to `chunk_size` bytes) in one
+    os.read, and passes it through a message_parser.  So the consumer gets
+    everything completed so far in one batch.  `parser.report()` gives the
+    message rate and parse errors.
+
+    If `capture` is set to a :class:`.capture`, the raw bytes read are
+    logged to it before they are parsed (see start_capture).
     '''
     close_on_eof = False
     read_len = None
+    chunk_size = 4096
+    capture = None
 
     def __init__(self, devnum = 0, timeout = 0, baud = B57600, crtscts = False,
                  format_strings = None):
@@ -138,6 +182,7 @@ class usb(terminal):
             self.fd = comm.open(devnum, timeout, baud = baud, crtscts=crtscts)
         self.name = "usb%d" % devnum
         self.format_strings = format_strings
+        self.parser = message_parser(format_strings)
 
     def do_start(self):
         try:
@@ -146,37 +191,249 @@ class usb(terminal):
             #sys.stderr.write("%s: caught KeyboardInterrupt\n" % self.name)
             pass
 
-    def read(self, n=1):
-        data = os.read(self.fd, n)
-        if len(data) > 0 and self.format_strings:
-            key = ord(data[0])
-            fs = self.format_strings[key]
-            data = ''
-            while fs.size > len(data):
-                data += os.read(self.fd, fs.size - len(data))
-            assert len(data) == fs.size, \
-                   "key %d: expected len %d, got %d" % \
-                     (key, fs.size, len(data))
-            return fs.format(data)
-        else:
-            return data
+    def read(self, n=None):
+        r'''Returns the text and messages read, in one str.
+
+        `n` (the consumer's read_len) is ignored; consumers must take the
+        data in whatever lengths it comes.
+        '''
+        data = os.read(self.fd, self.chunk_size)
+        cap = self.capture
+        if cap is not None: cap.write(data)
+        return self.parser.feed(data)
+
+    def start_capture(self, filename):
+        self.stop_capture()
+        self.capture = capture(filename)
+
+    def stop_capture(self):
+        r'''Returns the capture stopped (None if there wasn't one).
+        '''
+        cap, self.capture = self.capture, None
+        if cap is not None: cap.close()
+        return cap
+
+    def fileno(self):
+        return self.fd
 
     def write(self, s):
         comm.write(self.fd, s)
 
+    def write_frames(self, frames):
+        comm.write_frames(self.fd, frames)
+
     def do_close(self):
+        self.stop_capture()
         os.close(self.fd)
 
 
+class capture(object):
+    r'''Appends the raw bytes read from the Arduino to a binary log file.
+
+    The file starts with Capture_magic, then has one record per read: the
+    time it was read (a double) and the length (u4), both MSB first, then
+    the bytes.  The times never go backwards, even if the clock does.  See
+    capture_records to read it back, and replay to run it through the
+    consumers again.
+
+        >>> import tempfile
+        >>> filename = tempfile.mktemp()
+        >>> with capture(filename) as cap:
+        ...     cap.write('hi\x01'); cap.write('\x00\x05')
+        >>> with capture(filename) as cap:          # appends
+        ...     cap.write('bye\n')
+        >>> [data for t, data in capture_records(filename)]
+        ['hi\x01', '\x00\x05', 'bye\n']
+        >>> os.remove(filename)
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(Capture_magic)
+        self.last_time = 0.0
+        self.records = 0
+        self.bytes = 0
+        self.lock = threading.Lock()    # the shell may close it any time
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type = None, exc_value = None, exc_tb = None):
+        self.close()
+        return False
+
+    def write(self, data):
+        with self.lock:
+            if self.file.closed: return
+            self.last_time = max(time.time(), self.last_time)
+            self.file.write(Capture_record.pack(self.last_time, len(data)))
+            self.file.write(data)
+            self.records += 1
+            self.bytes += len(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+Capture_magic = 'pyterm capture 1\n'
+Capture_record = struct.Struct('>dI')       # time, length
+
+def capture_records(filename):
+    r'''Generates the (time, data) records in a capture file.
+    '''
+    with open(filename, 'rb') as f:
+        magic = f.read(len(Capture_magic))
+        if magic != Capture_magic:
+            raise ValueError("%s: not a pyterm capture file" % filename)
+        while True:
+            header = f.read(Capture_record.size)
+            if len(header) < Capture_record.size: break
+            t, length = Capture_record.unpack(header)
+            data = f.read(length)
+            if len(data) < length: break    # cut off while capturing
+            yield t, data
+
+class replay(terminal):
+    r'''Stands in for usb, reading from a capture file instead.
+
+    The captured reads are passed through a message_parser to the consumers
+    just as usb does, either with the same timing as they were captured
+    (`realtime`, with gaps cut to `max_gap` secs) or as fast as the
+    consumers take them.  Anything written to the Arduino is dropped.  At
+    the end, the parser's report (the throughput) goes to stderr and the
+    replay closes, which also stops its event_loop.
+
+        >>> import tempfile
+        >>> filename = tempfile.mktemp()
+        >>> with capture(filename) as cap:
+        ...     cap.write('hi\x01'); cap.write('\x00\x05bye\n')
+        >>> out = collector()
+        >>> source = replay(filename, {1: format_string("a=%d\n",
+        ...                                             ('unsigned', 2))},
+        ...                 realtime = False, report = None)
+        >>> source.push_consumer(out)
+        >>> source.start()
+        >>> out.data, source.closed, source.parser.messages
+        (['hi', 'a=5\nbye\n'], True, 1)
+        >>> os.remove(filename)
+    '''
+    close_on_eof = True
+    read_len = None
+
+    def __init__(self, filename, format_strings = None, realtime = True,
+                 max_gap = 1.0, report = sys.stderr):
+        super(replay, self).__init__()
+        self.name = "replay"
+        self.filename = filename
+        self.realtime = realtime
+        self.max_gap = max_gap
+        self.report = report
+        self.format_strings = format_strings
+        self.parser = message_parser(format_strings)
+        self.records = capture_records(filename)
+        self.file = open(filename, 'rb')   # only for fileno (always readable)
+        self.record = None          # the next (time, data) to pass on
+        self.last_time = None       # capture time of self.record
+        self.due = None             # when to pass on self.record
+
+    def do_start(self):
+        try:
+            self.run()
+        except KeyboardInterrupt:
+            pass
+
+    def next_record(self):
+        r'''Returns the next (time, data) record, None at the end.
+
+        Works out when it's due, if `realtime`.
+        '''
+        if self.record is None:
+            self.record = next(self.records, None)
+            if self.record is not None and self.realtime:
+                t = self.record[0]
+                if self.last_time is None:
+                    self.due = time.time()
+                else:
+                    self.due += min(t - self.last_time, self.max_gap)
+                self.last_time = t
+        return self.record
+
+    def wait_until(self):
+        if self.realtime and self.next_record() is not None:
+            return self.due
+        return None
+
+    def read(self, n=None):
+        r'''Passes on the next record.
+
+        In its own thread this sleeps until the record is due; an
+        event_loop only calls it then (see wait_until).
+        '''
+        record = self.next_record()
+        if record is None: return ''
+        if self.realtime and self.loop is None:
+            delay = self.due - time.time()
+            if delay > 0: time.sleep(delay)
+        self.record = None
+        return self.parser.feed(record[1])
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def write(self, s):
+        pass
+
+    def write_frames(self, frames):
+        pass
+
+    def do_close(self):
+        self.file.close()
+        if self.loop is not None:
+            self.loop.stop()        # the replay is the whole session
+        if self.report is not None:
+            self.report.write("%s: %s" % (self.filename,
+                                          self.parser.report()))
+
+
 class linux_terminal(terminal):
     r'''Reads and writes to the Linux terminal.
 
     This is run in its own thread; so its own thread waits on input from the
     Linux terminal.
+
+    Output goes through a :class:`.console`, so that the Arduino can't be
+    held up by the terminal.
     '''
     close_on_eof = True
     read_len = 1
     name = "linux_terminal"
+    pending = ''        # partial line read by on_readable
+
+    def __init__(self, consumer = None):
+        self.console = console(sys.stdout)
+        super(linux_terminal, self).__init__(consumer)
+
+    def fileno(self):
+        return sys.stdin.fileno()
+
+    def on_readable(self):
+        r'''Reads what's there, passing on each complete line.
+
+        raw_input can't be used here, as it may read ahead more lines than
+        it returns, which select then can't see.
+        '''
+        data = os.read(self.fileno(), 4096)
+        if not data:
+            if self.pending and self.destinations:
+                self.destinations[0].write(self.pending + '\n')
+            self.pending = ''
+            return False
+        self.pending += data
+        while '\n' in self.pending and self.destinations:
+            line, self.pending = self.pending.split('\n', 1)
+            self.destinations[0].write(line + '\n')
+        return bool(self.destinations)
 
     def read(self):
         #sys.stderr.write("linux_terminal read called\n")
@@ -188,28 +445,251 @@ class linux_terminal(terminal):
         return ans
 
     def write(self, s):
-        sys.stdout.write(escape(s.replace('\r', '')))
-        #sys.stdout.write(escape(s))
+        self.console.write(s)
 
     def do_close(self):
-        #sys.stderr.write("%s: interrupting main\n" % self.name)
-        os.kill(os.getpid(), signal.SIGINT)
+        self.console.close()
+        if self.loop is not None:
+            self.loop.stop()
+        elif not isinstance(threading.current_thread(), threading._MainThread):
+            # The main thread is done already if it's closing us (e.g., at
+            # the end of a replay).
+            #sys.stderr.write("%s: interrupting main\n" % self.name)
+            os.kill(os.getpid(), signal.SIGINT)
 
 
+class message_parser(object):
+    r'''Splits what the Arduino sends into format_string messages and text.
+
+    `format_strings` is a dict mapping the initial byte value to the
+    :class:`.format_string` object.  Any other bytes are passed on as text.
+    Data is fed in as it arrives, in chunks of any size; a message split
+    across chunks is held until the rest of it arrives.  feed returns the
+    text and formatted messages completed so far as one str.
+
+    A message that can't be formatted counts as a parse error, and is
+    replaced by an error line.
+
+        >>> p = message_parser({1: format_string("a=%d\n", ('unsigned', 2))})
+        >>> p.feed('hi\x01\x00'), p.feed('\x05bye\n\x01\x01\x00')
+        ('hi', 'a=5\nbye\na=256\n')
+        >>> p.messages, p.text_bytes, p.errors
+        (2, 6, 0)
+
+    Runs of the same message are decoded together (see iter_unpack), but
+    still formatted, and checked, one at a time:
+
+        >>> p.feed('\x01\x00\x01' * 3 + '\x01\x00')
+        'a=1\na=1\na=1\n'
+        >>> p.feed('\x02'), p.messages
+        ('a=2\n', 6)
+
+    So a message that fails doesn't hold up (or repeat) the rest of its run:
+
+        >>> class tens(format_string):
+        ...     calls = 0
+        ...     def fix_args(self, args):
+        ...         self.calls += 1
+        ...         return (10 // args[0],)
+        >>> fs = tens("%d\n", ('unsigned', 1))
+        >>> p = message_parser({3: fs})
+        >>> print(p.feed('\x03\x05\x03\x00\x03\x02'), end='')
+        2
+        <format 3: ZeroDivisionError('integer division or modulo by zero',) on '\x00'>
+        5
+        >>> fs.calls, p.messages, p.errors
+        (3, 2, 1)
+    '''
+    def __init__(self, format_strings = None):
+        self.format_strings = format_strings or {}
+        self.keys = re.compile('[%s]' % ''.join(re.escape(chr(key))
+                                               for key in self.format_strings)) \
+                      if self.format_strings else None
+        self.buffer = bytearray()
+        self.start_time = time.time()
+        self.bytes_in = 0
+        self.messages = 0
+        self.text_bytes = 0
+        self.errors = 0
+
+    def feed(self, data):
+        self.bytes_in += len(data)
+        if self.keys is None:
+            self.text_bytes += len(data)
+            return data
+        buf = self.buffer
+        buf += data
+        ans = []
+        i = 0               # start of what's not yet returned
+        while True:
+            m = self.keys.search(buf, i)
+            end = len(buf) if m is None else m.start()
+            if end > i:
+                ans.append(str(buf[i:end]))
+                self.text_bytes += end - i
+                i = end
+            if m is None: break
+            key = buf[i]
+            fs = self.format_strings[key]
+            step = 1 + fs.size
+            if i + step > len(buf): break           # wait for the rest
+            # Count the run of whole messages with this key to decode them
+            # in one go.
+            n = 1
+            while i + (n + 1) * step <= len(buf) and buf[i + n * step] == key:
+                n += 1
+            # fix_args is called exactly once for each message, as it may
+            # have side effects.
+            for args in iter_unpack(fs.record, buf, i, n):
+                try:
+                    ans.append(fs.format_args(args))
+                    self.messages += 1
+                except Exception, e:
+                    self.errors += 1
+                    ans.append("<format %d: %r on %r>\n" %
+                                 (key, e, str(buf[i + 1:i + step])))
+                i += step
+        del buf[:i]
+        return ''.join(ans)
+
+    def report(self):
+        secs = max(time.time() - self.start_time, 1e-6)
+        return "%d messages (%.1f/sec), %d text bytes, %d parse errors, " \
+               "%d bytes in (%.0f/sec)\n" % \
+                 (self.messages, self.messages / secs, self.text_bytes,
+                  self.errors, self.bytes_in, self.bytes_in / secs)
+
+# What escape shows as \xNN: control characters (other than newline) and
+# everything above DEL.
+Unprintable = ''.join(chr(n) for n in range(256)
+                             if (n < 0x20 or n > 127) and chr(n) != '\n')
+Escape_table = tuple('\\x%02x' % n if chr(n) in Unprintable else chr(n)
+                     for n in range(256))
+
 def escape(s):
-    ans = ''
-    for c in s:
-        n = ord(c)
-        if (n < 0x20 or n > 127) and c != '\n':
-            ans += '\\x%02x' % n
-        else:
-            ans += c
-    return ans
+    r'''Shows the unprintable characters in `s` as \xNN.
+
+        >>> print(escape('hi\tmom\xff\n'))
+        hi\x09mom\xff
+        <BLANKLINE>
+    '''
+    if len(s.translate(None, Unprintable)) == len(s):
+        return s                            # nothing to escape
+    return ''.join([Escape_table[n] for n in bytearray(s)])
+
+class console(object):
+    r'''Batches what's written to the Linux terminal into timed flushes.
+
+    write only queues the str, so the thread passing on what the Arduino
+    sends never waits on the terminal.  A background thread escapes
+    everything queued and writes it to `out` every `interval` secs.  A
+    write that would put more than `max_pending` bytes in the queue is
+    dropped, and a summary of how many lines were dropped is shown in its
+    place.  A write to an empty queue is always taken, however big.
+
+        >>> import StringIO
+        >>> out = StringIO.StringIO()
+        >>> con = console(out, max_pending = 10)
+        >>> con.write('hi\r\n'); con.write('\x01\n')
+        >>> con.flush()
+        >>> out.getvalue()
+        'hi\n\\x01\n'
+        >>> for i in range(5): con.write('line %d\n' % i)
+        >>> con.flush()
+        >>> print(out.getvalue()[8:], end='')
+        line 0
+        [console: 4 lines (28 bytes) dropped]
+        >>> con.dropped_lines
+        4
+        >>> con.write('x' * 20 + '\n'); con.flush()
+        >>> out.getvalue()[-21:]
+        'xxxxxxxxxxxxxxxxxxxx\n'
+    '''
+    def __init__(self, out = sys.stdout, interval = 0.05,
+                 max_pending = 1 << 16):
+        self.out = out
+        self.interval = interval
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.drop_lines = 0         # since last flush
+        self.drop_bytes = 0
+        self.dropped_lines = 0      # total
+        self.thread = None
+        self.closed = False
+
+    def write(self, s):
+        with self.lock:
+            if self.pending and \
+               self.pending_bytes + len(s) > self.max_pending:
+                self.drop_lines += s.count('\n')
+                self.drop_bytes += len(s)
+                return
+            self.pending.append(s)
+            self.pending_bytes += len(s)
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(target=self.run,
+                                               name="console")
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def run(self):
+        while not self.closed:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            data = ''.join(self.pending)
+            drop_lines, drop_bytes = self.drop_lines, self.drop_bytes
+            del self.pending[:]
+            self.pending_bytes = self.drop_lines = self.drop_bytes = 0
+            self.dropped_lines += drop_lines
+        if not data and not drop_bytes: return
+        data = escape(data.replace('\r', ''))
+        if drop_bytes:
+            if data and not data.endswith('\n'): data += '\n'
+            data += "[console: %d lines (%d bytes) dropped]\n" % \
+                      (drop_lines, drop_bytes)
+        self.out.write(data)
+        self.out.flush()
+
+    def close(self):
+        r'''Flushes what's left.  Later writes still go out (at the next
+        flush call).
+        '''
+        self.closed = True
+        if self.thread is not None and \
+           self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
 
 
 class shell(terminal):
+    r'''Runs the "!" commands typed, and sends anything else to the Arduino.
+
+    Commands normally run in the thread that passes on what's typed.  With
+    `background` set (as the 'select' backend does), they're queued to run
+    one at a time in a worker thread instead, so that a long command (like
+    show_forever) doesn't hold up the event_loop.  Their output then goes
+    through the Linux terminal's console just the same.
+
+        >>> def hello(output, close_output, arduino, name):
+        ...     output.write('hello %s from %s\n' %
+        ...                    (name, threading.current_thread().name))
+        >>> linux, arduino = collector(), collector()
+        >>> sh = shell(linux, arduino, hello = hello)
+        >>> sh.background = True
+        >>> sh.write('!hello mom\n'); sh.write('hi\n')
+        >>> sh.queue.join()
+        >>> linux.data, arduino.data
+        (['hello mom from shell_commands\n'], ['hi\n'])
+    '''
     read_len = None
     name = "command_processor"
+    background = False
+    queue = None        # of commands for the worker thread, once started
 
     def __init__(self, linux, arduino, **commands):
         super(shell, self).__init__()
@@ -220,7 +700,8 @@ class shell(terminal):
     def write(self, s):
         r'''This is run in the Linux terminal thread.
 
-        Commands are run in the Linux terminal thread too.
+        Commands are run in the Linux terminal thread too, unless
+        `background`.
         '''
         if s[0] != '!': self.arduino.write(s)
         else:
@@ -246,15 +727,40 @@ class shell(terminal):
                 #                   (self.name, self.arduino))
                 #sys.stderr.write("%s: args is %r\n" % (self.name, args[1:]))
 
-                self.commands[args[0]](out, close, self.arduino, *args[1:])
+                self.run_command(self.commands[args[0]], out, close, args[1:])
                 #sys.stderr.write("%s: command returned\n" % self.name)
 
+    def run_command(self, fn, out, close, args):
+        if not self.background:
+            fn(out, close, self.arduino, *args)
+            return
+        if self.queue is None:
+            self.queue = Queue.Queue()
+            worker = threading.Thread(target=self.command_worker,
+                                      name="shell_commands")
+            worker.setDaemon(True)
+            worker.start()
+        self.queue.put((fn, out, close, args))
+
+    def command_worker(self):
+        while True:
+            fn, out, close, args = self.queue.get()
+            try:
+                fn(out, close, self.arduino, *args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
 
 class format_string(object):
     r'''This is a format string for output from the Arduino.
 
     The args are tuples of type and length, where type is either "signed" or
-    "unsigned".
+    "unsigned", and length is 1, 2 or 4 (bytes, sent MSB first).  They may
+    also have a third element naming the field, for message_schema.c_header.
+
+    These are compiled into a struct.Struct to decode the message.
 
         >>> fs = format_string("hi mom\n")
         >>> fs.size
@@ -272,33 +778,278 @@ class format_string(object):
         14
         >>> fs.format('\xff\x12\x34\xff\xff\xff\xfe\xff\x12\x34\xff\xff\xff\xfe')
         's1=-1, s2=4660, s4=-2, u1=255, u2=4660, u4=4294967294\n'
+
+    format_many formats a run of whole messages, each with its key byte:
+
+        >>> fs = format_string("%d\n", ('unsigned', 2))
+        >>> fs.format_many(bytearray('\x03\x00\x01\x03\x01\x00'), 0, 2)
+        '1\n256\n'
     '''
+    Codes = {
+        ('signed', 1): 'b', ('unsigned', 1): 'B',
+        ('signed', 2): 'h', ('unsigned', 2): 'H',
+        ('signed', 4): 'i', ('unsigned', 4): 'I',
+    }
+
     def __init__(self, format_str, *args):
-        r'''args are ('signed'|'unsigned', length)
+        r'''args are ('signed'|'unsigned', length[, name])
         '''
         self.format_str = format_str
         self.args = args
-        self.size = sum(arg[1] for arg in args)
+        codes = ''.join(self.Codes[tuple(arg[:2])] for arg in args)
+        self.struct = struct.Struct('>' + codes)
+        self.record = struct.Struct('>x' + codes)  # with the key byte
+        self.size = self.struct.size
 
     def format(self, data):
-        data_start = 0
-        args = []
-        for type, length in self.args:
-            num = ord(data[data_start])
-            if type == 'signed':
-                if num & 0x80: num -= 256
-            for byte in data[data_start + 1:data_start + length]:
-                num = (num << 8) | ord(byte)
-            args.append(num)
-            data_start += length
-        return self.format_str % self.fix_args(args)
+        return self.format_args(self.struct.unpack(data))
+
+    def format_args(self, args):
+        r'''Formats the decoded args of one message.
+        '''
+        return self.format_str % self.fix_args(list(args))
+
+    def format_many(self, data, offset, count):
+        r'''Formats `count` messages, with their key bytes, from `data`
+        starting at `offset`.
+        '''
+        return ''.join(self.format_args(args)
+                       for args in iter_unpack(self.record, data, offset,
+                                               count))
 
     def fix_args(self, args):
         return tuple(args)
 
+def iter_unpack(st, data, offset = 0, count = None):
+    r'''Generates the tuples for `count` struct.Struct `st` records in a row.
+
+    Like Struct.iter_unpack (Python 3.4 on), but starting at `offset`.
+
+        >>> list(iter_unpack(struct.Struct('>H'), 'x\x00\x01\x00\x02', 1))
+        [(1,), (2,)]
+    '''
+    if count is None: count = (len(data) - offset) // st.size
+    for i in xrange(offset, offset + count * st.size, st.size):
+        yield st.unpack_from(data, i)
+
+class message_schema(object):
+    r'''Declares the messages that an Arduino sketch sends.
+
+    Each message is given as (NAME, id, format_string).  The id is the
+    message's first byte.  format_strings() gives the dict that usb takes;
+    c_header() gives the #defines for the sketch, so that the ids and sizes
+    on both sides come from here.
+
+        >>> schema = message_schema('test',
+        ...            ('HELLO', 1, format_string("hi %d\n",
+        ...                                       ('unsigned', 2, 'count'))))
+        >>> schema.format_strings()[1].format('\x00\x05')
+        'hi 5\n'
+        >>> print(schema.c_header())   # doctest: +ELLIPSIS
+        // test_messages.h
+        ...
+        // hi %d\n
+        //   count (u2)
+        #define HELLO_MSG                1
+        #define HELLO_MSG_SIZE           2
+        <BLANKLINE>
+        #endif /* TEST_MESSAGES_H */
+        <BLANKLINE>
+    '''
+    def __init__(self, name, *messages):
+        self.name = name
+        self.messages = messages
+        ids = [id for _, id, _ in messages]
+        assert len(set(ids)) == len(ids), \
+               "message_schema %s: duplicate ids" % name
+
+    def format_strings(self):
+        return dict((id, fs) for _, id, fs in self.messages)
+
+    def c_header(self, filename = None):
+        if filename is None: filename = self.name + '_messages.h'
+        guard = os.path.basename(filename).upper().replace('.', '_')
+        lines = [
+            "// %s" % os.path.basename(filename),
+            "",
+            "// Generated from the %s message_schema, don't edit!" % self.name,
+            "//",
+            "// Each message is its id byte, then the fields MSB first.",
+            "",
+            "#ifndef %s" % guard,
+            "#define %s" % guard,
+        ]
+        for name, id, fs in self.messages:
+            lines.append("")
+            lines.append("// " + fs.format_str.encode('string_escape'))
+            for i, arg in enumerate(fs.args):
+                lines.append("//   %s (%s%d)" %
+                               (arg[2] if len(arg) > 2 else "arg%d" % i,
+                                arg[0][0], arg[1]))
+            lines.append("#define %-24s %d" % (name + '_MSG', id))
+            lines.append("#define %-24s %d" % (name + '_MSG_SIZE', fs.size))
+        lines.append("")
+        lines.append("#endif /* %s */" % guard)
+        return '\n'.join(lines) + '\n'
+
+    def write_c_header(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.c_header(filename))
+
+class event_loop(object):
+    r'''Runs any number of terminals in one thread, using select.
+
+    This is the alternative to giving each terminal its own thread.  Each
+    terminal added has its fileno() watched, and its on_readable method
+    called whenever there's something to read.  When that returns False,
+    the terminal is closed and dropped.  The loop runs until stop is called
+    (from any thread, or from a terminal's do_close), or no terminals are
+    left; either way the terminals still running are closed on the way out.
+    A terminal can also ask to be called at a given time instead (see
+    terminal.wait_until), which sets the select timeout.
+
+    A shell's commands would hold up all of the terminals until they
+    return, so start runs them in the background (see shell).
+
+        >>> r, w = os.pipe()
+        >>> pipe, out = pipe_terminal(r), collector()
+        >>> pipe.push_consumer(out)
+        >>> loop = event_loop()
+        >>> loop.add(pipe)
+        >>> _ = os.write(w, 'hello'); os.close(w)
+        >>> loop.run()
+        >>> out.data, pipe.closed, len(loop)
+        (['hello'], True, 0)
+    '''
+    def __init__(self):
+        self.terminals = {}         # {fd: terminal}
+        self.stopped = False
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def __len__(self):
+        return len(self.terminals)
+
+    def add(self, term):
+        assert term.destinations, "%s: added with no push_consumer" % term.name
+        term.loop = self
+        self.terminals[term.fileno()] = term
+
+    def remove(self, term):
+        self.terminals.pop(term.fileno(), None)
+        term.loop = None
+
+    def stop(self):
+        r'''Makes run return.  May be called from any thread.
+        '''
+        self.stopped = True
+        if self.wakeup_w is not None:
+            os.write(self.wakeup_w, 'x')
+
+    def run(self):
+        try:
+            while self.terminals and not self.stopped:
+                timers = {}         # {fd: time.time() when due}
+                for fd, term in self.terminals.items():
+                    due = term.wait_until()
+                    if due is not None: timers[fd] = due
+                watch = [fd for fd in self.terminals if fd not in timers]
+                timeout = max(0.0, min(timers.values()) - time.time()) \
+                            if timers else None
+                try:
+                    ready = select.select(watch + [self.wakeup_r],
+                                          [], [], timeout)[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR: continue
+                    raise
+                now = time.time()
+                ready += [fd for fd, due in timers.items() if due <= now]
+                for fd in ready:
+                    if fd == self.wakeup_r:
+                        os.read(self.wakeup_r, 100)
+                        continue
+                    term = self.terminals.get(fd)
+                    if term is None or term.closed: continue
+                    try:
+                        done = not term.on_readable()
+                    except Exception:
+                        traceback.print_exc()
+                        done = True
+                    if done:
+                        self.close_terminal(term)
+                    if self.stopped: break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for term in self.terminals.values():
+                self.close_terminal(term)
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+            self.wakeup_w = None
+
+    def close_terminal(self, term):
+        fd = term.fileno()
+        term.close()
+        self.terminals.pop(fd, None)
+        term.loop = None
+
+# Test fixtures for the doctests.
+
+class collector(terminal):
+    r'''Keeps a list of everything written to it.
+    '''
+    read_len = None
+    name = "collector"
+
+    def __init__(self):
+        super(collector, self).__init__()
+        self.data = []
+
+    def write(self, s):
+        self.data.append(s)
+
+    def do_close(self):
+        pass
+
+class pipe_terminal(terminal):
+    r'''Reads from the pipe `fd` until EOF.
+    '''
+    close_on_eof = True
+    read_len = None
+    name = "pipe"
+
+    def __init__(self, fd):
+        super(pipe_terminal, self).__init__()
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        return os.read(self.fd, 100)
+
+    def do_close(self):
+        os.close(self.fd)
+
 def start(devnum = 0, timeout = 0, baud = B57600, crtscts = False,
-          commands = None, format_strings = None):
-    with usb(devnum, timeout, baud, crtscts, format_strings) as arduino:
+          commands = None, format_strings = None, backend = 'threads',
+          capture_to = None, replay_from = None, realtime = True):
+    r'''Connects the Arduino, the Linux terminal and a shell.
+
+    With the 'threads' backend, the Linux terminal runs in its own thread
+    and the Arduino in the main thread.  With the 'select' backend, both
+    run in the main thread in an event_loop, and the shell's commands run
+    in a worker thread.
+
+    `capture_to` names a file to log what the Arduino sends to (see
+    capture).  `replay_from` names a capture file to read instead of the
+    Arduino, in `realtime` or as fast as possible (see replay).
+    '''
+    if replay_from is None:
+        source = usb(devnum, timeout, baud, crtscts, format_strings)
+        if capture_to is not None: source.start_capture(capture_to)
+    else:
+        source = replay(replay_from, format_strings, realtime)
+    with source as arduino:
         with linux_terminal() as linux:
             arduino.push_consumer(linux)
             #sys.stderr.write("did arduino.push_consumer(linux)\n")
@@ -309,6 +1060,13 @@ def start(devnum = 0, timeout = 0, baud = B57600, crtscts = False,
             #sys.stderr.write("created shell\n")
             linux.push_consumer(sh)
             #sys.stderr.write("did linux.push_consumer(sh)\n")
+            if backend == 'select':
+                sh.background = True
+                loop = event_loop()
+                loop.add(linux)
+                loop.add(arduino)
+                loop.run()
+                return
             linux.start()
             #sys.stderr.write("did linux.start()\n")
             arduino.start()
@@ -340,6 +1098,18 @@ def run(timeout = None, baud = None, crtscts = None, commands = None,
                           action="store_true", default=False,
                           help="Enable hardware flow control (CTS)")
 
+    parser.add_option("-e", "--event-loop", dest="backend",
+                      action="store_const", const="select", default="threads",
+                      help="Run all terminals in one thread with select")
+
+    parser.add_option("--capture", metavar="FILE",
+                      help="Log the raw bytes from the Arduino to FILE")
+    parser.add_option("--replay", metavar="FILE",
+                      help="Read a --capture FILE instead of the Arduino")
+    parser.add_option("--fast", dest="realtime",
+                      action="store_false", default=True,
+                      help="Replay as fast as possible, not in real time")
+
     if commands is None:
         parser.add_option("-c", "--commands", metavar="PYTHON.MODULE",
                           action='callback', type="string",
@@ -353,7 +1123,8 @@ def run(timeout = None, baud = None, crtscts = None, commands = None,
     if commands is not None: options.commands = commands, format_strings
 
     start(options.devnum, options.timeout, Baud_rates[options.baud],
-          options.crtscts, options.commands[0], options.commands[1])
+          options.crtscts, options.commands[0], options.commands[1],
+          options.backend, options.capture, options.replay, options.realtime)
 
 def get_commands(option, opt, module_path, parser):
     print("option", option)
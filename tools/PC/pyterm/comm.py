@@ -238,12 +238,63 @@ def readline(fd, strip_nulls=False):
         print 'got', num_nulls, 'null chars'
     return line[:-1]
 
+Coalesce_size = 1 << 16     # bytes gathered into each write by write_frames
+
 def write(fd, s):
     r'''Write string `s` to `fd`, ensuring that the whole string is taken.
+
+    `s` may also be a bytearray, buffer or memoryview.  After a short
+    write, the rest is written from a memoryview slice (rather than copying
+    what's left of `s` each time).  Returns the number of system calls
+    made.
+
+        >>> r, w = os.pipe()
+        >>> write(w, 'hi ' * 3), os.read(r, 100)
+        (1, 'hi hi hi ')
+    '''
+    view = memoryview(s)
+    calls = 0
+    while len(view):
+        l = os.write(fd, view)
+        calls += 1
+        view = view[l:]
+    return calls
+
+def write_frames(fd, frames, coalesce_size = None):
+    r'''Writes each of `frames` to `fd`, with as few system calls as
+    possible.
+
+    The frames are gathered until there are `coalesce_size` bytes
+    (Coalesce_size by default), which are then copied into one bytearray
+    and written all at once.  Returns the number of system calls made.
+
+        >>> r, w = os.pipe()
+        >>> write_frames(w, ['ab', bytearray('cd'), buffer('xef', 1)]), \
+        ...   os.read(r, 100)
+        (1, 'abcdef')
     '''
-    while s:
-        l = os.write(fd, s)
-        s = s[l:]
+    if coalesce_size is None: coalesce_size = Coalesce_size
+    calls = 0
+    batch = []
+    batch_bytes = 0
+    for frame in frames:
+        batch.append(frame)
+        batch_bytes += len(frame)
+        if batch_bytes >= coalesce_size:
+            calls += send_batch(fd, batch)
+            batch = []
+            batch_bytes = 0
+    if batch:
+        calls += send_batch(fd, batch)
+    return calls
+
+def send_batch(fd, batch):
+    if len(batch) == 1:
+        return write(fd, batch[0])
+    buf = bytearray()
+    for frame in batch:
+        buf += frame
+    return write(fd, buf)
 
 def run(devnum = 0, command = 'h'):
     r'''Open device and send a single command.
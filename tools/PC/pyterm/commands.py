@@ -3,6 +3,8 @@
 from __future__ import division
 import sys
 
+import numpy
+
 def signed(char):
     r'''
         >>> signed(0x00)
@@ -58,13 +60,54 @@ def command(desc):
     return fn_dec
 
 class readers(object):
+    r'''Base class for commands that take fixed size samples from the Arduino.
+
+    Subclasses set `read_len` (the bytes per sample) and `num_samples`, and
+    define either process, which is called with the bytes of each sample
+    (as ints), or process_batch, which is called with all of the whole
+    samples that have arrived as a numpy uint8 array of shape
+    (n, read_len).  During process_batch, `samples_seen` doesn't yet count
+    these samples; and the array is only good until it returns.  Either one
+    returns True to stop early.
+
+    The data is kept in a bytearray that only grows when a write won't fit,
+    so each byte is copied into it once.
+
+        >>> class sums(readers):
+        ...     read_len = 2
+        ...     num_samples = 3
+        ...     def process(self, a, b): self.output.write('%d\n' % (a + b))
+        ...     def wrapup(self): self.output.write('done\n')
+        >>> arduino = fake_arduino()
+        >>> r = sums(sys.stdout, False, arduino)
+        >>> arduino.consumer.write('\x01\x02\x03')
+        3
+        >>> arduino.consumer.write('\x04\x05\x06')
+        7
+        11
+        done
+        >>> class batch_sums(sums):
+        ...     def process_batch(self, samples):
+        ...         self.output.write('%r\n' % samples.tolist())
+        >>> r = batch_sums(sys.stdout, False, arduino)
+        >>> arduino.consumer.write('\x01\x02\x03')
+        [[1, 2]]
+        >>> arduino.consumer.write('\x04\x05\x06\x07')
+        [[3, 4], [5, 6]]
+        Excess samples returned
+        done
+    '''
+    process_batch = None
+    Initial_size = 1 << 12
+
     def __init__(self, output, close_output, arduino, args = ()):
         self.output = output
         self.close_output = close_output
         self.arduino = arduino
         self.args = args
         self.producer = None
-        self.buffer = ''
+        self.buffer = bytearray(self.Initial_size)
+        self.start = self.end = 0   # the unprocessed data in self.buffer
         self.samples_seen = 0
         try:
             arduino.push_consumer(self)
@@ -91,28 +134,79 @@ class readers(object):
 
     def write(self, s):
         try:
-            buf = self.buffer + s
-            while len(buf) >= self.read_len:
-                self.samples_seen += 1
-                done = self.process(*(ord(x) for x in buf[:self.read_len]))
-                buf = buf[self.read_len:]
-                if done or self.samples_seen >= self.num_samples:
-                    self.arduino.pop_consumer(self)
-                    if buf:
-                        self.output.write("Excess samples returned\n")
-                    self.wrapup()
-                    if self.close_output:
-                        #sys.stderr.write("closing %s\n" % self.output.name)
-                        self.output.close()
-                    return
-            self.buffer = buf
+            self.append(s)
+            if self.process_batch is None:
+                done = self.process_each()
+            else:
+                done = self.process_all()
+            if done or self.samples_seen >= self.num_samples:
+                self.arduino.pop_consumer(self)
+                if self.end > self.start:
+                    self.output.write("Excess samples returned\n")
+                self.wrapup()
+                if self.close_output:
+                    #sys.stderr.write("closing %s\n" % self.output.name)
+                    self.output.close()
         except Exception, e:
             #sys.stderr.write("streamers.write: caught %r exception\n" % e)
             if self.close_output: self.output.close()
             raise
 
+    def append(self, s):
+        r'''Copies s onto the end of the unprocessed data.
+
+        The buffer is never resized in place, as process_batch's arrays may
+        still be holding on to it.
+        '''
+        n = len(s)
+        if self.end + n > len(self.buffer):
+            pending = self.buffer[self.start:self.end]
+            if len(pending) + n > len(self.buffer):
+                self.buffer = bytearray(max(2 * len(self.buffer),
+                                            len(pending) + n))
+            self.buffer[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+        self.buffer[self.end:self.end + n] = s
+        self.end += n
+
+    def process_each(self):
+        read_len = self.read_len
+        while self.end - self.start >= read_len:
+            self.samples_seen += 1
+            sample = self.buffer[self.start:self.start + read_len]
+            self.start += read_len
+            if self.process(*sample) or \
+               self.samples_seen >= self.num_samples:
+                return True
+        return False
+
+    def process_all(self):
+        n = min((self.end - self.start) // self.read_len,
+                self.num_samples - self.samples_seen)
+        if n <= 0: return False
+        samples = numpy.frombuffer(self.buffer, numpy.uint8,
+                                   n * self.read_len, self.start) \
+                       .reshape(n, self.read_len)
+        done = self.process_batch(samples)
+        self.samples_seen += n
+        self.start += n * self.read_len
+        return done
+
     def wrapup(self): pass
 
+class fake_arduino(object):
+    r'''Stands in for the usb terminal in the doctests.
+
+    Write to `consumer` to feed the command that's reading.
+    '''
+    consumer = None
+
+    def push_consumer(self, consumer):
+        self.consumer = consumer
+
+    def pop_consumer(self, consumer):
+        self.consumer = None
+
 
 @command("%(name)s")
 def help(output, close_output, arduino):
@@ -122,3 +216,34 @@ def help(output, close_output, arduino):
         output.write('  ' + cmd.description % {'name': cmd.__name__} + '\n')
     if close_output: output.close()
 
+@command("%(name)s")
+def stats(output, close_output, arduino):
+    r'''Reports what the Arduino has sent (see aterm.message_parser).
+    '''
+    if hasattr(arduino, 'parser'):
+        output.write(arduino.parser.report())
+    else:
+        output.write("no stats for %s\n" % getattr(arduino, 'name', arduino))
+    if close_output: output.close()
+
+@command("%(name)s [filename|off]")
+def capture(output, close_output, arduino, filename = None):
+    r'''Starts (or stops) logging the raw bytes from the Arduino to a file.
+
+    See aterm.capture; the file can be run again with aterm's --replay.
+    Only a usb terminal can be captured (not a replay).
+    '''
+    if not hasattr(arduino, 'start_capture'):
+        output.write("can't capture from %s\n" %
+                       getattr(arduino, 'name', arduino))
+    elif filename is None or filename == 'off':
+        cap = arduino.stop_capture()
+        if cap is None:
+            output.write("not capturing\n")
+        else:
+            output.write("captured %d bytes in %d reads to %s\n" %
+                           (cap.bytes, cap.records, cap.filename))
+    else:
+        arduino.start_capture(filename)
+        output.write("capturing to %s\n" % filename)
+    if close_output: output.close()
@@ -4,6 +4,8 @@ from __future__ import division
 import sys
 import time
 
+import numpy
+
 from pyterm import commands
 
 Inches_per_sec2_for_1g = 385.28
@@ -49,14 +51,23 @@ def avg(histogram):
         -128.0
         >>> avg([0] * 255 + [2])
         -1.0
+        >>> avg(numpy.bincount([1, 2, 255], minlength=256))
+        0.6666666666666666
+        >>> avg([0] * 256)
+        Traceback (most recent call last):
+            ...
+        ZeroDivisionError: avg of an empty histogram
     '''
-    total_count = sum = 0
-    for i, count in enumerate(histogram):
-        total_count += count
-        sum += commands.signed(i) * count
-    return sum / total_count
+    histogram = numpy.asarray(histogram)
+    total_count = int(histogram.sum())
+    if total_count == 0:
+        raise ZeroDivisionError("avg of an empty histogram")
+    return float(numpy.dot(Signed[:len(histogram)], histogram)) / total_count
+
+# commands.signed of each byte value.
+Signed = numpy.arange(256) - 256 * (numpy.arange(256) >= 128)
 
-class streamers(commands.reader):
+class streamers(commands.readers):
     read_len = 6
     arduino_command = 's'
     description = "%(name)s num_samples"
@@ -65,13 +76,30 @@ class streamers(commands.reader):
         self.num_samples = int(num_samples)
 
 class histogram(streamers):
+    r'''Counts each reading of each axis, a whole batch of samples at a time.
+
+        >>> arduino = commands.fake_arduino()
+        >>> h = histogram(sys.stdout, False, arduino, 3)
+        >>> arduino.consumer.write('\0\0\1\1\2\3'  '\0\0\1\1\2\xfd')
+        >>> arduino.consumer.write('\0\0\0\1\2\3')
+        x:
+          1: 3
+        y:
+          2: 3
+        z:
+          3: 2
+          -3: 1
+        1: overruns
+    '''
     def do_init(self):
-        self.counts = [[0] * 256 for i in range(3)]
+        self.counts = numpy.zeros((3, 256), dtype=numpy.int64)
         self.num_overruns = 0
-    def process(self, timeh, timel, status, *readings):
-        for i, reading in enumerate(readings):
-            self.counts[i][reading] += 1
-        if self.samples_seen > 1 and status: self.num_overruns += 1
+    def process_batch(self, samples):
+        for i in range(3):
+            self.counts[i] += numpy.bincount(samples[:, 3 + i], minlength=256)
+        # The first sample's status doesn't count.
+        status = samples[1:, 2] if self.samples_seen == 0 else samples[:, 2]
+        self.num_overruns += int(numpy.count_nonzero(status))
     def wrapup(self):
         for name, readings in zip(('x', 'y', 'z'), self.counts):
             self.output.write(name + ":\n")
@@ -252,6 +280,7 @@ Commands = {
     'echo': echo,
     'echo_track': echo_track,
     'help': commands.help,
+    'capture': commands.capture,
     'audio': audio,
 }
 